@@ -1,2 +1,2 @@
 __author__ = 'Gjum'
-__all__ = ['drawutils', 'main', 'reload', 'skins', 'subscriber', 'window']
+__all__ = ['bench', 'cell_index', 'connection', 'drawutils', 'frame', 'history', 'interpolation', 'layers', 'localserver', 'main', 'merged', 'profiling', 'reload', 'replay', 'skins', 'subscriber', 'threat', 'view', 'window', 'worker']
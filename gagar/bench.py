@@ -0,0 +1,250 @@
+"""
+Headless benchmark of the drawing pipeline.
+
+Draws seeded synthetic worlds with the same subscribers GtkControl uses
+onto a cairo ImageSurface, without any window or server,
+and prints per-handler and total frame times as JSON.
+
+    python -m gagar.bench --cells 100,1000,10000,50000 --output before.json
+"""
+import argparse
+from contextlib import redirect_stdout
+import json
+import random
+import sys
+from time import perf_counter
+
+import cairo
+
+from agarnet.client import Client
+from agarnet.vec import Vec
+from .drawutils import Canvas
+from .layers import sub_draw_layers
+from .subscriber import MultiSubscriber
+from .view import WorldView
+
+DRAW_EVENTS = ('on_draw_background', 'on_draw_cells', 'on_draw_hud')
+
+# agar.io uses a few colors for food and ejected mass
+PALETTE = [(255, 7, 7), (255, 135, 7), (255, 255, 7), (135, 255, 7),
+           (7, 255, 7), (7, 255, 135), (7, 255, 255), (7, 135, 255),
+           (7, 7, 255), (135, 7, 255), (255, 7, 255), (255, 7, 135)]
+VIRUS_COLOR = (51, 255, 51)
+
+
+def percentiles(times):
+    """Milliseconds statistics of a list of durations in seconds."""
+    times = sorted(times)
+    n = len(times)
+    if not n:
+        return {}
+    return {
+        'p50': 1000 * times[int(.50 * (n - 1))],
+        'p99': 1000 * times[int(.99 * (n - 1))],
+        'mean': 1000 * sum(times) / n,
+        'max': 1000 * times[-1],
+    }
+
+
+class SyntheticWorld(object):
+    """
+    Fills a client's world with random cells and moves them around,
+    sending the same subscriber events a server connection would.
+    """
+
+    def __init__(self, client, num_cells, rng, world_size=11180,
+                 food=.75, viruses=.02, players=.08):
+        self.client = client
+        self.subscriber = client.subscriber
+        self.rng = rng
+        self.world_size = world_size
+        self.cells = {}  # cid -> cell info kwargs
+        self.moving = []  # cids of player cells
+
+        world = client.player.world
+        world.top_left = Vec(0, 0)
+        world.bottom_right = Vec(world_size, world_size)
+        self.subscriber.on_world_rect(left=0, top=0,
+                                      right=world_size, bottom=world_size)
+
+        kinds = ('food', 'virus', 'player', 'ejected')
+        weights = (food, viruses, players, max(0, 1 - food - viruses - players))
+        for cid in range(1, num_cells + 1):
+            kind = rng.choices(kinds, weights)[0]
+            self.cells[cid] = self.random_cell(cid, kind)
+            if kind == 'player':
+                self.moving.append(cid)
+
+        # own cell in the middle of the world
+        own_id = num_cells + 1
+        own_cell = self.random_cell(own_id, 'player')
+        own_cell.update(x=world_size / 2, y=world_size / 2, size=100,
+                        name='benchmark')
+        self.cells[own_id] = own_cell
+        self.moving.append(own_id)
+
+        self.send_update(self.cells)
+        client.player.own_ids.add(own_id)
+        client.player.cells_changed()
+        self.subscriber.on_own_id(cid=own_id)
+
+    def random_cell(self, cid, kind):
+        rng = self.rng
+        cell = dict(cid=cid, x=rng.uniform(0, self.world_size),
+                    y=rng.uniform(0, self.world_size), name='',
+                    is_virus=False, is_agitated=False)
+        if kind == 'food':
+            cell.update(size=rng.randint(10, 14), color=rng.choice(PALETTE))
+        elif kind == 'virus':
+            cell.update(size=100, color=VIRUS_COLOR, is_virus=True)
+        elif kind == 'ejected':
+            cell.update(size=rng.choice((37, 38)), color=rng.choice(PALETTE))
+        else:
+            cell.update(size=int(30 + 270 * rng.random() ** 3),
+                        color=tuple(rng.randint(0, 255) for _ in range(3)),
+                        name='player %i' % rng.randint(1, 50))
+        return cell
+
+    def send_update(self, cells):
+        world = self.client.player.world
+        self.subscriber.on_world_update_pre()
+        for cid, cell in cells.items():
+            self.subscriber.on_cell_info(**cell)
+            if cid not in world.cells:
+                world.create_cell(cid)
+            world.cells[cid].update(**cell)
+        if self.client.player.is_alive:
+            self.client.player.cells_changed()
+        self.subscriber.on_world_update_post()
+
+    def step(self):
+        """Move all player cells a bit, like one world update."""
+        rng = self.rng
+        moved = {}
+        for cid in self.moving:
+            cell = self.cells[cid]
+            cell['x'] = min(self.world_size, max(0, cell['x'] + rng.uniform(-20, 20)))
+            cell['y'] = min(self.world_size, max(0, cell['y'] + rng.uniform(-20, 20)))
+            moved[cid] = cell
+        self.send_update(moved)
+
+
+def run(num_cells, args):
+    multi_sub = MultiSubscriber()
+    client = Client(multi_sub)
+    cell_index, interpolator = sub_draw_layers(multi_sub, client)
+
+    view = WorldView(client.player.world)
+    view.win_size.set(args.width, args.height)
+    view.mouse_pos = view.win_size / 2
+    view.draw_subscriber = multi_sub
+    view.cell_index = cell_index
+    view.interpolator = interpolator
+
+    world = SyntheticWorld(client, num_cells, random.Random(args.seed),
+                           world_size=args.world_size, food=args.food,
+                           viruses=args.viruses, players=args.players)
+    if args.full_world:
+        view.show_full_world(client.player.world)
+    else:
+        view.focus_player(client.player)
+
+    # look up each handler once, keyed by a readable unique name
+    handlers = []
+    for event in DRAW_EVENTS:
+        for handler in multi_sub.handlers(event):
+            name = '%s.%s' % (type(handler.__self__).__name__, event)
+            while name in (n for n, _ in handlers):
+                name += "'"
+            handlers.append((name, handler))
+
+    surface = cairo.ImageSurface(cairo.FORMAT_ARGB32, args.width, args.height)
+    frame_times = []
+    update_times = []
+    prepare_times = []
+    handler_times = {name: [] for name, _ in handlers}
+    visible = 0
+
+    for frame in range(args.warmup + args.frames):
+        measure = frame >= args.warmup
+
+        if frame % args.update_every == 0:
+            t = perf_counter()
+            world.step()
+            if measure:
+                update_times.append(perf_counter() - t)
+
+        c = Canvas(cairo.Context(surface))
+        frame_start = perf_counter()
+        view.prepare_frame()
+        prepare_end = perf_counter()
+        durations = []
+        for name, handler in handlers:
+            t = perf_counter()
+            handler(c, view)
+            durations.append(perf_counter() - t)
+        surface.flush()
+        frame_end = perf_counter()
+
+        if measure:
+            frame_times.append(frame_end - frame_start)
+            prepare_times.append(prepare_end - frame_start)
+            for (name, _), duration in zip(handlers, durations):
+                handler_times[name].append(duration)
+            visible += len(view.visible_cells)
+
+    handler_stats = {'WorldView.prepare_frame': percentiles(prepare_times)}
+    for name, _ in handlers:
+        handler_stats[name] = percentiles(handler_times[name])
+    return {
+        'cells': num_cells,
+        'visible_cells': visible / max(1, args.frames),
+        'frames': args.frames,
+        'frame_ms': percentiles(frame_times),
+        'world_update_ms': percentiles(update_times),
+        'handlers_ms': handler_stats,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the gagar drawing pipeline without a window.')
+    parser.add_argument('--cells', default='100,1000,10000,50000',
+                        help='comma separated world sizes in cells')
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20,
+                        help='frames drawn before measuring')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--food', type=float, default=.75,
+                        help='fraction of food cells')
+    parser.add_argument('--viruses', type=float, default=.02,
+                        help='fraction of viruses')
+    parser.add_argument('--players', type=float, default=.08,
+                        help='fraction of named player cells, '
+                             'the rest is ejected mass')
+    parser.add_argument('--world-size', type=float, default=11180)
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--update-every', type=int, default=2,
+                        help='frames per simulated world update')
+    parser.add_argument('--full-world', action='store_true',
+                        help='draw the whole world instead of following a player')
+    parser.add_argument('--output', help='write JSON here instead of stdout')
+    args = parser.parse_args()
+
+    results = []
+    # subscribers log to stdout, keep it clean for the JSON
+    with redirect_stdout(sys.stderr):
+        for num_cells in args.cells.split(','):
+            results.append(run(int(num_cells), args))
+
+    report = json.dumps({'args': vars(args), 'results': results}, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""
+Indices over the cells of a world that are kept up to date by world updates,
+so drawing does not need to look at every cell on every frame.
+"""
+from bisect import bisect_left, insort
+from collections import defaultdict
+
+from .subscriber import Subscriber
+
+
+class SpatialHash(object):
+    """
+    Uniform grid over world coordinates.
+    Each key is stored in every grid cell its bounding box touches,
+    so a rectangle query only has to look at the grid cells it overlaps.
+    """
+
+    def __init__(self, cell_size=300):
+        self.cell_size = cell_size
+        self._grid = defaultdict(set)  # (gx, gy) -> keys touching that grid cell
+        self._bounds = {}  # key -> (gx_min, gy_min, gx_max, gy_max)
+
+    def __len__(self):
+        return len(self._bounds)
+
+    def __contains__(self, key):
+        return key in self._bounds
+
+    def _grid_rect(self, left, top, right, bottom):
+        s = self.cell_size
+        return int(left // s), int(top // s), int(right // s), int(bottom // s)
+
+    def insert(self, key, x, y, radius):
+        """Adds the key, or moves it if it is already present."""
+        bounds = self._grid_rect(x - radius, y - radius, x + radius, y + radius)
+        old_bounds = self._bounds.get(key)
+        if old_bounds == bounds:
+            return  # still touches the same grid cells
+        if old_bounds:
+            self._unlink(key, old_bounds)
+        self._bounds[key] = bounds
+        grid = self._grid
+        gx_min, gy_min, gx_max, gy_max = bounds
+        for gx in range(gx_min, gx_max + 1):
+            for gy in range(gy_min, gy_max + 1):
+                grid[gx, gy].add(key)
+
+    def remove(self, key):
+        bounds = self._bounds.pop(key, None)
+        if bounds:
+            self._unlink(key, bounds)
+
+    def _unlink(self, key, bounds):
+        grid = self._grid
+        gx_min, gy_min, gx_max, gy_max = bounds
+        for gx in range(gx_min, gx_max + 1):
+            for gy in range(gy_min, gy_max + 1):
+                bucket = grid[gx, gy]
+                bucket.discard(key)
+                if not bucket:
+                    del grid[gx, gy]
+
+    def clear(self):
+        self._grid.clear()
+        self._bounds.clear()
+
+    def query(self, left, top, right, bottom):
+        """
+        Finds all keys whose bounding box may intersect the rectangle.
+        Can contain some keys slightly outside the rectangle,
+        never misses one inside it.
+        :return set of keys
+        """
+        gx_min, gy_min, gx_max, gy_max = self._grid_rect(left, top, right, bottom)
+        grid = self._grid
+        found = set()
+        if (gx_max - gx_min + 1) * (gy_max - gy_min + 1) >= len(grid):
+            # zoomed out, faster to check the occupied grid cells
+            for (gx, gy), bucket in grid.items():
+                if gx_min <= gx <= gx_max and gy_min <= gy <= gy_max:
+                    found.update(bucket)
+        else:
+            for gx in range(gx_min, gx_max + 1):
+                for gy in range(gy_min, gy_max + 1):
+                    bucket = grid.get((gx, gy))
+                    if bucket:
+                        found.update(bucket)
+        return found
+
+
+class DrawOrder(object):
+    """
+    Keys sorted by size, largest first (small cells get drawn over large ones).
+    Patched when a key is added, removed or resized,
+    instead of sorting everything again for every frame.
+    """
+
+    def __init__(self):
+        self._sorted = []  # (-size, key), ascending
+        self._sizes = {}  # key -> size
+
+    def __len__(self):
+        return len(self._sizes)
+
+    def __iter__(self):
+        return (key for _, key in self._sorted)
+
+    def insert(self, key, size):
+        """Adds the key, or moves it if its size changed."""
+        old_size = self._sizes.get(key)
+        if old_size == size:
+            return
+        if old_size is not None:
+            self._unlink(key, old_size)
+        self._sizes[key] = size
+        insort(self._sorted, (-size, key))
+
+    def remove(self, key):
+        size = self._sizes.pop(key, None)
+        if size is not None:
+            self._unlink(key, size)
+
+    def _unlink(self, key, size):
+        del self._sorted[bisect_left(self._sorted, (-size, key))]
+
+    def clear(self):
+        self._sorted.clear()
+        self._sizes.clear()
+
+    def ordered(self, keys):
+        """Sorts a subset of the keys into draw order."""
+        if len(keys) == len(self._sizes):
+            return list(self)
+        if len(keys) * 4 < len(self._sizes):  # few keys, sorting is cheaper
+            sizes = self._sizes
+            return sorted(keys, key=lambda key: (-sizes[key], key))
+        return [key for key in self if key in keys]
+
+
+class CellIndex(Subscriber):
+    """
+    Keeps a SpatialHash and a DrawOrder of the cells in one world,
+    updated from the cell events of that world's client.
+    """
+
+    def __init__(self, world, cell_size=300):
+        self.world = world
+        self.spatial = SpatialHash(cell_size)
+        self.draw_order = DrawOrder()
+
+    def on_cell_info(self, cid, x, y, size, **_):
+        self.spatial.insert(cid, x, y, size)
+        self.draw_order.insert(cid, size)
+
+    def on_cell_removed(self, cid):
+        self.spatial.remove(cid)
+        self.draw_order.remove(cid)
+
+    def on_cell_eaten(self, eater_id, eaten_id):
+        self.on_cell_removed(eaten_id)
+
+    def on_clear_cells(self):
+        self.spatial.clear()
+        self.draw_order.clear()
+
+    # the world gets reset when connecting
+    on_sock_open = on_clear_cells
+
+    def cells_in_rect(self, left, top, right, bottom):
+        """
+        All cells that may intersect the world rectangle,
+        in draw order (largest first).
+        """
+        cells = self.world.cells
+        cids = self.spatial.query(left, top, right, bottom)
+        # skip cids the world does not have (yet), on_cell_info
+        # is sent before the client creates the cell
+        return [cells[cid] for cid in self.draw_order.ordered(cids)
+                if cid in cells]
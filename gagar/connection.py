@@ -0,0 +1,70 @@
+"""
+Connecting to servers in the background, so the caller's main loop keeps running.
+
+open_connection() does all the blocking work (server discovery, party lookup,
+websocket handshake) and is meant to run in an executor. The resulting websocket gets
+wrapped in a PreparedSocket and handed to Client.connect() on the main thread,
+which then only sends the handshake packets.
+"""
+import select
+
+import websocket
+
+from agarnet.utils import find_server, get_party_address
+
+PARTY = 'party'  # address of the party server that belongs to the token
+
+
+def open_connection(address=None, token=None, timeout=5):
+    """
+    Blocking, finds a server if no address is given and connects to it.
+    :param address: 'IP:port', PARTY or None for any server
+    :return (address, token, connected websocket)
+    """
+    if not address:
+        address, token = find_server()
+    elif address == PARTY:
+        address = get_party_address(token)
+    ws = websocket.WebSocket()
+    ws.settimeout(timeout)
+    ws.connect('ws://%s' % address, origin='http://agar.io')
+    return address, token, ws
+
+
+def socket_readable(ws):
+    """True if the websocket has received data that was not read yet."""
+    sock = ws.sock
+    if sock is None:
+        return False
+    pending = getattr(sock, 'pending', None)  # decrypted, buffered by ssl
+    if pending and pending():
+        return True
+    return bool(select.select([sock], [], [], 0)[0])
+
+
+def backoff_delay(attempt, min_delay=.5, max_delay=30.):
+    """Seconds to wait before the `attempt`-th retry, doubling each time."""
+    return min(max_delay, min_delay * 2 ** attempt)
+
+
+class PreparedSocket(object):
+    """
+    Wraps a websocket that got connected by open_connection(),
+    so Client.connect() adopts it instead of connecting again.
+    Reports being disconnected until adopted,
+    because Client.connect() refuses to connect an already connected socket.
+    """
+
+    def __init__(self, ws):
+        self._ws = ws
+        self.adopted = False
+
+    @property
+    def connected(self):
+        return self.adopted and self._ws.connected
+
+    def connect(self, *args, **kwargs):
+        self.adopted = True
+
+    def __getattr__(self, name):
+        return getattr(self._ws, name)
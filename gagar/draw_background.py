@@ -1,3 +1,5 @@
+import cairo
+
 from .drawutils import *
 from .subscriber import Subscriber
 
@@ -11,16 +13,58 @@ class SolidBackground(Subscriber):
 
 
 class GridDrawer(Subscriber):
+    """
+    Draws the grid as one repeating pattern instead of one stroke per line.
+    The tile only gets rendered again when the zoom changes noticeably,
+    panning just moves the pattern.
+    """
+
+    def __init__(self, spacing=50, width=.5, color=to_rgba(LIGHT_GRAY, .3)):
+        """
+        :param spacing: distance between lines, in world size
+        """
+        self.spacing = spacing
+        self.width = width
+        self.color = color
+        self.tile = None
+        self.tile_spacing = None  # pixels between lines in the tile
+
+    def get_tile(self, spacing):
+        # round the screen spacing, so the tile only changes
+        # when zooming by more than a pixel
+        tile_spacing = max(2, int(round(spacing)))
+        if tile_spacing != self.tile_spacing:
+            self.tile_spacing = tile_spacing
+            # several lines per tile, so the pattern repeats less often
+            lines = max(1, 64 // tile_spacing)
+            size = lines * tile_spacing
+            self.tile = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+            c = cairo.Context(self.tile)
+            c.set_source_rgba(*self.color)
+            for i in range(lines):
+                # lines are centered on the grid, the half before 0
+                # is drawn by the tile to the left/above
+                pos = i * tile_spacing
+                c.rectangle(pos, 0, self.width / 2, size)
+                c.rectangle(0, pos, size, self.width / 2)
+                c.rectangle(pos + tile_spacing - self.width / 2, 0,
+                            self.width / 2, size)
+                c.rectangle(0, pos + tile_spacing - self.width / 2,
+                            size, self.width / 2)
+            c.fill()
+        return self.tile
+
     def on_draw_background(self, c, w):
         wl, wt = w.world_to_screen_pos(w.world.top_left)
         wr, wb = w.world_to_screen_pos(w.world.bottom_right)
-        grid_spacing = w.world_to_screen_size(50)
-        for y in frange(wt, wb, grid_spacing):
-            c.draw_line((wl, y), (wr, y), width=.5,
-                        color=to_rgba(LIGHT_GRAY, .3))
-        for x in frange(wl, wr, grid_spacing):
-            c.draw_line((x, wt), (x, wb), width=.5,
-                        color=to_rgba(LIGHT_GRAY, .3))
+        left, top = max(wl, 0), max(wt, 0)
+        right, bottom = min(wr, w.win_size.x), min(wb, w.win_size.y)
+        if right <= left or bottom <= top:
+            return
+        spacing = w.world_to_screen_size(self.spacing)
+        tile = self.get_tile(spacing)
+        c.fill_tiled(tile, (wl, wt), (left, top), (right, bottom),
+                     scale=spacing / self.tile_spacing)
 
 
 class WorldBorderDrawer(Subscriber):
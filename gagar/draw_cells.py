@@ -1,134 +1,167 @@
-from time import time
+from time import monotonic
+
+import numpy
 
 from agarnet.vec import Vec
+from . import threat
 from .subscriber import Subscriber
 from .drawutils import *
+from .frame import EJECTED, FOOD
 
 info_size = 14
 
 
-def nick_size(cell, w):
-    return max(14, w.world_to_screen_size(.3 * cell.size))
+def nick_size(radius):
+    """Font size of the name of a cell with this radius on screen."""
+    return max(14, .3 * radius)
 
 
 class CellsDrawer(Subscriber):
     def on_draw_cells(self, c, w):
-        # reverse to show small over large cells
-        for cell in sorted(w.world.cells.values(), reverse=True):
-            pos = w.world_to_screen_pos(cell.pos)
-            c.fill_circle(pos, w.world_to_screen_size(cell.size),
-                          color=to_rgba(cell.color, .8))
+        # already sorted to show small over large cells
+        f = w.frame
+        small = (f.flags & (FOOD | EJECTED)) != 0
+        cells = list(zip(f.cells, f.x.tolist(), f.y.tolist(),
+                         f.radius.tolist(), small.tolist()))
+        with c.batch():
+            for cell, x, y, radius, is_small in cells:
+                if not is_small:
+                    c.fill_circle((x, y), radius,
+                                  color=to_rgba(cell.color, .8))
+        # food and ejected mass are smaller than any player cell and
+        # hardly overlap each other, one path per color is enough
+        with c.batch(reorder=True):
+            for cell, x, y, radius, is_small in cells:
+                if is_small:
+                    c.fill_circle((x, y), radius,
+                                  color=to_rgba(cell.color, .8))
 
 
 class CellNames(Subscriber):
     def on_draw_cells(self, c, w):
-        for cell in w.world.cells.values():
+        f = w.frame
+        for cell, x, y, radius in zip(f.cells, f.x.tolist(), f.y.tolist(),
+                                      f.radius.tolist()):
             if cell.name:
-                pos = w.world_to_screen_pos(cell.pos)
-                size = nick_size(cell, w)
-                c.draw_text(pos, '%s' % cell.name,
-                            align='center', outline=(BLACK, 2), size=size)
+                c.draw_text((x, y), '%s' % cell.name, align='center',
+                            outline=(BLACK, 2), size=nick_size(radius))
 
 
 class RemergeTimes(Subscriber):
-    def __init__(self, client):
+    def __init__(self, client, history):
+        """:param history: CellHistory of the drawn world"""
         self.client = client
-        self.split_times = {}
-
-    def on_own_id(self, cid):
-        self.split_times[cid] = time()
+        self.history = history
 
     def on_draw_cells(self, c, w):
         player = self.client.player
         if len(player.own_ids) <= 1:
             return  # dead or only one cell, no remerge time to display
-        now = time()
-        for cell in player.own_cells:
-            if cell.cid not in self.split_times: continue
-            split_for = now - self.split_times[cell.cid]
+        now = monotonic()
+        for cell in w.own_cells:
+            record = self.history.get(cell.cid)
+            if not record or record.split_time is None: continue
+            split_for = now - record.split_time
             # formula by HungryBlob
             ttr = max(30, cell.size // 5) - split_for
             if ttr < 0: continue
             pos = w.world_to_screen_pos(cell.pos)
-            pos.isub(Vec(0, (info_size + nick_size(cell, w)) / 2))
-            c.draw_text(pos, 'TTR %.1fs' % ttr,
-                        align='center', outline=(BLACK, 2), size=info_size)
+            radius = w.world_to_screen_size(cell.size)
+            pos.isub(Vec(0, (info_size + nick_size(radius)) / 2))
+            c.draw_text(pos, 'TTR %.1fs' % ttr, align='center',
+                        outline=(BLACK, 2), size=info_size, cache=False)
 
 
 class CellMasses(Subscriber):
     def on_draw_cells(self, c, w):
-        for cell in w.world.cells.values():
-            if cell.is_food or cell.is_ejected_mass or cell.mass < 5:
-                continue
-            pos = w.world_to_screen_pos(cell.pos)
-            if cell.name:
-                pos.iadd(Vec(0, (info_size + nick_size(cell, w)) / 2))
-            c.draw_text(pos, '%i' % cell.mass,
+        f = w.frame
+        shown = f.without(FOOD | EJECTED)
+        shown = shown[f.mass[shown] >= 5]
+        for i, x, y, radius, mass in zip(
+                shown.tolist(), f.x[shown].tolist(), f.y[shown].tolist(),
+                f.radius[shown].tolist(), f.mass[shown].tolist()):
+            if f.cells[i].name:
+                y += (info_size + nick_size(radius)) / 2
+            c.draw_text((x, y), '%i' % mass,
                         align='center', outline=(BLACK, 2), size=info_size)
 
 
 class CellHostility(Subscriber):
+    COLORS = {
+        threat.SPLIT_PREY: PURPLE,
+        threat.PREY: GREEN,
+        threat.SIMILAR: YELLOW,
+        threat.PREDATOR: ORANGE,
+        threat.SPLIT_PREDATOR: RED,
+    }
+
+    def __init__(self, threats):
+        """:param threats: ThreatAnalysis of the drawn player"""
+        self.threats = threats
+
     def on_draw_cells(self, c, w):
-        if not w.player.is_alive: return  # nothing to be hostile against
-        own_min_mass = min(c.mass for c in w.player.own_cells)
-        own_max_mass = max(c.mass for c in w.player.own_cells)
-        for cell in w.world.cells.values():
-            if cell.is_food or cell.is_ejected_mass:
-                continue  # no threat
-            if cell.cid in w.player.own_ids:
-                continue  # own cell, also no threat lol
-            pos = w.world_to_screen_pos(cell.pos)
-            color = YELLOW
-            if cell.is_virus:
-                if own_max_mass > cell.mass:
-                    color = RED
-                else:
-                    continue  # no threat, do not mark
-            elif own_min_mass > cell.mass * 1.33 * 2:
-                color = PURPLE
-            elif own_min_mass > cell.mass * 1.33:
-                color = GREEN
-            elif cell.mass > own_min_mass * 1.33 * 2:
-                color = RED
-            elif cell.mass > own_min_mass * 1.33:
-                color = ORANGE
-            c.stroke_circle(pos, w.world_to_screen_size(cell.size),
-                            width=5, color=color)
+        if not w.player or not w.player.is_alive:
+            return  # nothing to be hostile against
+        f = w.frame
+        index = self.threats.lookup(f.cid)
+        threats = self.threats.threat[index]
+        virus_danger = self.threats.virus_danger[index]
+        shown = numpy.flatnonzero((threats != threat.NONE) | virus_danger)
+        colors = self.COLORS
+        with c.batch():
+            for x, y, radius, cls, is_virus in zip(
+                    f.x[shown].tolist(), f.y[shown].tolist(),
+                    f.radius[shown].tolist(), threats[shown].tolist(),
+                    virus_danger[shown].tolist()):
+                color = RED if is_virus else colors[cls]
+                c.stroke_circle((x, y), radius, width=5, color=color)
 
 
 class ForceFields(Subscriber):
+    def __init__(self, threats):
+        """:param threats: ThreatAnalysis of the drawn player"""
+        self.threats = threats
+
     def on_draw_cells(self, c, w):
-        split_dist = 760
-        for cell in w.player.own_cells:
-            pos = w.world_to_screen_pos(cell.pos)
-            radius = split_dist + cell.size * .7071
-            c.stroke_circle(pos, w.world_to_screen_size(radius),
-                            width=3, color=to_rgba(PURPLE, .5))
-
-        if w.player.is_alive:
-            own_max_size = max(c.size for c in w.player.own_cells)
-            own_min_mass = min(c.mass for c in w.player.own_cells)
-        else:  # spectating or dead, still draw some lines
-            own_max_size = own_min_mass = 0
-
-        for cell in w.world.cells.values():
-            if cell.size < 60:
-                continue  # cannot split
-            if cell.cid in w.player.own_ids:
-                continue  # own cell, not hostile
-            pos = w.world_to_screen_pos(cell.pos)
-            if cell.is_virus:
-                if own_max_size > cell.size:  # dangerous virus
-                    c.stroke_circle(pos, w.world_to_screen_size(own_max_size),
-                                    width=3, color=to_rgba(RED, .5))
-            elif cell.mass > own_min_mass * 1.33 * 2:  # can split+kill me
-                radius = max(split_dist + cell.size * .7071, cell.size)
+        with c.batch():
+            for cell in w.own_cells:
+                pos = w.world_to_screen_pos(cell.pos)
+                radius = threat.SPLIT_DIST + cell.size * .7071
+                c.stroke_circle(pos, w.world_to_screen_size(radius),
+                                width=3, color=to_rgba(PURPLE, .5))
+
+            # split kills reach into the window from outside of it
+            cells = w.cells_in_view(margin=threat.SPLIT_DIST)
+            index = self.threats.lookup([cell.cid for cell in cells])
+            split_radius = self.threats.split_radius[index].tolist()
+            virus_danger = self.threats.virus_danger[index].tolist()
+            own_max_size = self.threats.own_max_size
+            for i, cell in enumerate(cells):
+                if not (virus_danger[i] or split_radius[i]):
+                    continue
+                pos = w.world_to_screen_pos(cell.pos)
+                if virus_danger[i]:
+                    radius = own_max_size
+                else:  # can split+kill me
+                    radius = split_radius[i]
                 c.stroke_circle(pos, w.world_to_screen_size(radius),
                                 width=3, color=to_rgba(RED, .5))
 
 
 class MovementLines(Subscriber):
+    def __init__(self, history):
+        """:param history: CellHistory of the drawn world"""
+        self.history = history
+
     def on_draw_cells(self, c, w):
-        for cell in w.player.own_cells:
-            c.draw_line(w.world_to_screen_pos(cell.pos), w.mouse_pos,
+        for cell in w.own_cells:
+            pos = w.world_to_screen_pos(cell.pos)
+            record = self.history.get(cell.cid)
+            if record and record.trail:
+                # where the cell came from
+                trail = [w.world_to_screen_pos(Vec(x, y))
+                         for _, x, y in record.trail]
+                c.draw_line(*trail, pos, width=2,
+                            color=to_rgba(WHITE, .3))
+            c.draw_line(pos, w.mouse_pos,
                         width=1, color=to_rgba(BLACK, .3))
@@ -1,6 +1,12 @@
+import atexit
 from collections import deque
+from itertools import islice
+from math import ceil
 from time import time
 
+import cairo
+import numpy
+
 from agarnet.vec import Vec
 
 from .drawutils import *
@@ -8,6 +14,64 @@ from .subscriber import Subscriber
 
 
 class Minimap(Subscriber):
+    """
+    Shows the whole world in the bottom right corner.
+    The cells are rasterized into a small image a few times per second,
+    or drawn as circles every frame if `raster` is False.
+    """
+
+    def __init__(self, raster=True, resolution=128, update_rate=5):
+        """
+        :param raster: draw the cells as a raster image
+        :param resolution: width and height of the raster, in pixels
+        :param update_rate: times per second the raster gets updated
+        """
+        self.raster = raster
+        self.resolution = resolution
+        self.update_interval = 1 / update_rate
+        self.last_update = 0
+        self.pixels = None  # keeps the surface's memory alive
+        self.surface = None
+
+    def rasterize(self, world):
+        """Draws the cells' mass into a new ARGB image, colored by the cells."""
+        res = self.resolution
+        cells = list(world.cells.values())
+        pixels = numpy.zeros((res, res, 4), dtype=numpy.uint8)
+        if cells:
+            pos = numpy.array([(cell.pos.x, cell.pos.y) for cell in cells])
+            size = numpy.array([cell.size for cell in cells], dtype=float)
+            color = numpy.array([cell.color for cell in cells], dtype=float)
+            scale = res / world.size.x
+            col = ((pos[:, 0] - world.top_left.x) * scale).astype(int)
+            row = ((pos[:, 1] - world.top_left.y) * scale).astype(int)
+            index = row.clip(0, res - 1) * res + col.clip(0, res - 1)
+
+            mass = size * size / 100
+            density = numpy.bincount(index, mass, minlength=res * res)
+            rgb = numpy.stack([numpy.bincount(index, mass * color[:, i],
+                                              minlength=res * res)
+                               for i in range(3)], axis=1)
+            filled = density > 0
+            rgb[filled] /= density[filled, None]  # mass-weighted mean color
+
+            peak = density.max()
+            if peak > 0:  # all cells have size 0 before their first update
+                # log scale, so food is visible next to big cells
+                alpha = numpy.log1p(density) / numpy.log1p(peak)
+                alpha[filled] = .3 + .7 * alpha[filled]
+
+                # cairo's ARGB32 is premultiplied,
+                # BGRA in memory (little endian)
+                pixels[:, :, 2::-1] = (rgb * alpha[:, None] * 255) \
+                    .reshape(res, res, 3)
+                pixels[:, :, 3] = (alpha * 255).reshape(res, res)
+        self.pixels = pixels
+        self.surface = cairo.ImageSurface.create_for_data(
+            pixels.data, cairo.FORMAT_ARGB32, res, res,
+            cairo.ImageSurface.format_stride_for_width(
+                cairo.FORMAT_ARGB32, res))
+
     def on_draw_hud(self, c, w):
         if w.world.size:
             minimap_w = w.win_size.x / 5
@@ -23,25 +87,39 @@ class Minimap(Subscriber):
             c.fill_rect(minimap_offset, size=minimap_size,
                         color=to_rgba(DARK_GRAY, .8))
 
+            if self.raster:
+                now = time()
+                if now - self.last_update >= self.update_interval:
+                    self.last_update = now
+                    self.rasterize(w.world)
+                c.draw_surface(self.surface, minimap_offset,
+                               scale=minimap_w / self.resolution)
+            else:
+                with c.batch():
+                    for cell in w.world.cells.values():
+                        c.stroke_circle(world_to_map(cell.pos),
+                                        cell.size * minimap_scale,
+                                        color=to_rgba(cell.color, .8))
+
             # outline the area visible in window
             c.stroke_rect(world_to_map(w.screen_to_world_pos(Vec(0, 0))),
                           world_to_map(w.screen_to_world_pos(w.win_size)),
                           width=1, color=BLACK)
 
-            for cell in w.world.cells.values():
-                c.stroke_circle(world_to_map(cell.pos),
-                                cell.size * minimap_scale,
-                                color=to_rgba(cell.color, .8))
-
 
 class Leaderboard(Subscriber):
-    def on_draw_hud(self, c, w):
-        c.draw_text((w.win_size.x - 10, 30), 'Leaderboard',
-                    align='right', color=WHITE, outline=(BLACK, 2), size=27)
+    MARGIN = 10  # between the text and the layer's edges
+
+    def __init__(self):
+        self.layer = RetainedLayer()
+        self.rows = None
+        self.width = 0  # of the layer, fits the widest row
 
+    def on_draw_hud(self, c, w):
         player_cid = min(c.cid for c in w.player.own_cells) \
             if w.player and w.player.own_ids else -1
 
+        rows = []
         for rank, (cid, name) in enumerate(w.world.leaderboard_names):
             rank += 1  # start at rank 1
             name = name or 'An unnamed cell'
@@ -52,37 +130,332 @@ class Leaderboard(Subscriber):
                 color = LIGHT_GRAY
             else:
                 color = WHITE
-            c.draw_text((w.win_size.x - 10, 40 + 23*rank), text,
-                        align='right', color=color, outline=(BLACK, 2), size=18)
+            rows.append((text, color))
+        rows = tuple(rows)
+        if rows != self.rows:  # only measure the names when they change
+            self.rows = rows
+            text_width = max([c.text_width('Leaderboard', size=27)]
+                             + [c.text_width(text, size=18) for text, _ in rows])
+            self.width = ceil(text_width) + 2 * self.MARGIN + 4  # outline
+
+        def render(c):
+            right = self.width - self.MARGIN
+            c.draw_text((right, 30), 'Leaderboard',
+                        align='right', color=WHITE, outline=(BLACK, 2), size=27)
+            for rank, (text, color) in enumerate(rows):
+                c.draw_text((right, 40 + 23 * (rank + 1)), text, align='right',
+                            color=color, outline=(BLACK, 2), size=18)
+
+        height = 40 + 23 * (len(rows) + 1)
+        self.layer.draw(c, (w.win_size.x - self.width, 0),
+                        (self.width, height), rows, render)
+
+
+def largest_triangles(points, before, after, bucket_size):
+    """
+    Downsamples (x, y) points to one point per bucket of `bucket_size`,
+    keeping the one that spans the largest triangle with the point kept
+    before it and the average of the next bucket, so peaks survive.
+    :param before: point before `points`, None to keep the first one
+    :param after: point after `points`, None if there is none
+    """
+    buckets = [points[i:i + bucket_size]
+               for i in range(0, len(points), bucket_size)]
+    kept = []
+    for i, bucket in enumerate(buckets):
+        if i + 1 < len(buckets):
+            following = buckets[i + 1]
+            cx = sum(p[0] for p in following) / len(following)
+            cy = sum(p[1] for p in following) / len(following)
+        else:
+            cx, cy = after or bucket[-1]
+        if before is None:
+            best = bucket[0]
+        else:
+            ax, ay = before
+            best = max(bucket, key=lambda p: abs(
+                (ax - cx) * (p[1] - ay) - (ax - p[0]) * (cy - ay)))
+        kept.append(best)
+        before = best
+    return kept
+
+
+class MassHistory(object):
+    """
+    Samples of (sample number, mass) with bounded memory.
+    The newest `tier_size` samples are kept as they are,
+    older ones get downsampled by `ratio` per tier.
+    When the oldest tier is full, it gets halved, and from then on
+    takes twice as many points for each point it keeps,
+    so it covers all of the history at an even resolution.
+    """
+
+    def __init__(self, tier_size=100, num_tiers=3, ratio=4, chunk=4):
+        """
+        :param chunk: points a tier passes on at once, after downsampling
+        """
+        self.tier_size = tier_size
+        self.ratio = ratio
+        self.chunk = chunk
+        self.tiers = [deque() for _ in range(num_tiers)]  # newest tier first
+        self.stride = 1  # points the oldest tier takes for each point it keeps
+        self.grouped = 0  # points taken since the oldest tier kept one
+        self.candidate = None  # point the oldest tier will keep next
+        self.count = 0  # samples added
+        self.max_mass = 0
+
+    def __len__(self):
+        return sum(len(tier) for tier in self.tiers)
+
+    def clear(self):
+        for tier in self.tiers:
+            tier.clear()
+        self.stride = 1
+        self.grouped = 0
+        self.candidate = None
+        self.count = 0
+        self.max_mass = 0
+
+    def add(self, mass):
+        self.tiers[0].append((self.count, mass))
+        self.count += 1
+        if mass > self.max_mass:
+            self.max_mass = mass
+        for i, tier in enumerate(self.tiers[:-1]):
+            if len(tier) <= self.tier_size:
+                return
+            oldest = [tier.popleft() for _ in range(self.chunk * self.ratio)]
+            older = self.tiers[i + 1]
+            if i + 2 < len(self.tiers):
+                older.extend(largest_triangles(
+                    oldest, older[-1] if older else None, tier[0], self.ratio))
+            else:
+                self._add_oldest(oldest)
+
+    def _add_oldest(self, points):
+        last = self.tiers[-1]
+        for point in points:
+            # of each group of `stride` points, keep the one that differs
+            # most from the point kept before, so peaks and dips survive
+            ref = last[-1][1] if last else point[1]
+            if self.candidate is None \
+                    or abs(point[1] - ref) > abs(self.candidate[1] - ref):
+                self.candidate = point
+            self.grouped += 1
+            if self.grouped < self.stride:
+                continue
+            last.append(self.candidate)
+            self.candidate = None
+            self.grouped = 0
+            if len(last) > self.tier_size:
+                halved = largest_triangles(list(last), None, None, 2)
+                last.clear()
+                last.extend(halved)
+                self.stride *= 2
+
+    def samples(self):
+        """All kept samples, oldest first."""
+        yield from self.tiers[-1]
+        if self.candidate:
+            yield self.candidate
+        for tier in reversed(self.tiers[:-1]):
+            yield from tier
 
 
 class MassGraph(Subscriber):
     def __init__(self, client):
         self.client = client
-        self.graph = []
+        self.history = MassHistory()
+        self.layer = RetainedLayer()
 
     def on_respawn(self):
-        self.graph.clear()
+        self.history.clear()
 
     def on_world_update_post(self):
         player = self.client.player
         if not player.is_alive:
             return
-        sample = (
-            player.total_mass,
-            sorted((c.cid, c.mass) for c in player.own_cells)
-        )
-        self.graph.append(sample)
+        self.history.add(player.total_mass)
 
     def on_draw_hud(self, c, w):
-        if not self.graph:
+        history = self.history
+        if not history.count:
             return
-        scale_x = w.INFO_SIZE / len(self.graph)
-        scale_y = w.INFO_SIZE / (max(self.graph)[0] or 10)
-        points = [(w.INFO_SIZE, 0), (0, 0)]
-        for i, (total_mass, masses) in enumerate(reversed(self.graph)):
-            points.append((i * scale_x, total_mass * scale_y))
-        c.fill_polygon(*points, color=to_rgba(BLUE, .3))
+
+        def render(c):
+            # newest sample on the left
+            newest = history.count - 1
+            scale_x = w.INFO_SIZE / history.count
+            scale_y = w.INFO_SIZE / (history.max_mass or 10)
+            points = [(w.INFO_SIZE, 0), (0, 0)]
+            for num, mass in reversed(list(history.samples())):
+                points.append(((newest - num) * scale_x, mass * scale_y))
+            c.fill_polygon(*points, color=to_rgba(BLUE, .3))
+
+        self.layer.draw(c, (0, 0), (w.INFO_SIZE, w.INFO_SIZE),
+                        history.count, render)
+
+
+def format_log(lines, width, indent='  '):
+    width = int(width)
+    for l in lines:
+        ind = ''
+        while len(l) > len(ind):
+            yield l[:width]
+            ind = indent
+            l = ind + l[width:]
+
+
+class Logger(Subscriber):
+    """
+    Shows the last `max_msgs` messages, wrapped to the HUD width.
+    Each message is only wrapped again when it changes or the width changes.
+    """
+
+    def __init__(self, client, max_msgs=100, log_path=None):
+        """
+        :param log_path: append all new messages to this file
+        """
+        self.client = client
+        self.log_msgs = deque(maxlen=max_msgs)
+        self.log_lines = deque(maxlen=max_msgs)  # wrapped msg, None if not yet
+        # True for msgs that got updated, they likely change again soon
+        self.log_updated = deque(maxlen=max_msgs)
+        self.wrap_width = None
+        self.log_file = None
+        if log_path:
+            self.log_file = open(log_path, 'a', buffering=1)
+            atexit.register(self.close)
+        self.leader_best = 11 # outside leaderboard, to show first msg on >=10
+        self.version = 0  # changes with the log, for redrawing the layer
+        self.layer = RetainedLayer()
+        self.lines = []  # (wrapped line, cache it) on screen
+        self.lines_key = None
+
+    def close(self):
+        """Closes the log file, if any."""
+        if self.log_file:
+            self.log_file.close()
+            self.log_file = None
+
+    def on_log_msg(self, msg, update=0, tag='[LOG]'):
+        """
+        Updates last `update` msgs with new data.
+        Compares first 5 chars or up to first space.
+        Set update=0 for no updating.
+        """
+        first_space = msg.index(' ') if ' ' in msg else 5
+        for i, log_msg in enumerate(islice(reversed(self.log_msgs), update)):
+            if msg[:first_space] == log_msg[:first_space]:
+                if log_msg != msg:
+                    self.log_msgs[-i - 1] = msg
+                    self.log_lines[-i - 1] = None
+                    self.log_updated[-i - 1] = True
+                    self.version += 1
+                break
+        else:
+            self.version += 1
+            self.log_msgs.append(msg)
+            self.log_lines.append(None)
+            self.log_updated.append(False)
+            if self.log_file:
+                self.log_file.write('%s %s\n' % (tag, msg))
+            try:
+                print(tag, msg)
+            except UnicodeEncodeError:
+                pass
+
+    def on_update_msg(self, msg, update=9):
+        self.on_log_msg(msg=msg, update=update)
+
+    def on_connect_error(self, msg):
+        self.on_log_msg(msg, tag='[ERROR]')
+
+    on_message_error = on_connect_error
+
+    def on_sock_open(self):
+        self.on_update_msg('Connected to %s' % self.client.address)
+        self.on_update_msg('Token: %s' % self.client.server_token)
+
+    def on_world_rect(self, **kwargs):
+        self.on_update_msg('World is from %(left)i:%(top)i to %(right)i:%(bottom)i' % kwargs)
+
+    def on_server_version(self, number, text):
+        self.on_log_msg('Server version %s from %s' % (number, text))
+
+    def on_cell_eaten(self, eater_id, eaten_id):
+        player = self.client.player
+        if eaten_id in player.own_ids:
+            name = 'Someone'
+            if eater_id in player.world.cells:
+                name = '"%s"' % player.world.cells[eater_id].name
+            what = 'killed' if len(player.own_ids) <= 1 else 'ate'
+            msg = '%s %s me!' % (name, what)
+            self.on_update_msg(msg)
+
+    def on_world_update_post(self):
+        player = self.client.player
+        x, y = player.center
+        self.on_update_msg('Mass: %i Pos: (%.2f %.2f)' % (player.total_mass, x, y))
+
+    def on_own_id(self, cid):
+        if len(self.client.player.own_ids) == 1:
+            self.on_log_msg('Respawned as %s' % self.client.player.nick)
+        else:
+            self.on_update_msg('Split into %i cells' % len(self.client.player.own_ids))
+
+    def on_leaderboard_names(self, leaderboard):
+        if not self.client.player.own_ids:
+            return
+        our_cid = min(c.cid for c in self.client.player.own_cells)
+        for rank, (cid, name) in enumerate(leaderboard):
+            if cid == our_cid:
+                rank += 1  # start at rank 1
+                self.leader_best = min(rank, self.leader_best)
+                msg = 'Leaderboard: %i. (best: %i.)' % (rank, self.leader_best)
+                self.on_update_msg(msg)
+
+    def on_draw_hud(self, c, w):
+        # scrolling log
+        log_line_h = 12
+        log_char_w = 6  # seems to work with my font
+        max_lines = int(w.INFO_SIZE / log_line_h)
+
+        width = int(w.INFO_SIZE / log_char_w)
+        if width != self.wrap_width:
+            self.wrap_width = width
+            self.log_lines = deque([None] * len(self.log_msgs),
+                                   maxlen=self.log_lines.maxlen)
+
+        key = self.version, max_lines, width
+        if key != self.lines_key:  # only collect the lines when the log changed
+            self.lines_key = key
+            chunks = []
+            num_lines = 0
+            # newest msgs first, until the screen is full
+            for i in range(len(self.log_msgs) - 1, -1, -1):
+                wrapped = self.log_lines[i]
+                if wrapped is None:
+                    wrapped = list(format_log((self.log_msgs[i],), width))
+                    self.log_lines[i] = wrapped
+                cache = not self.log_updated[i]
+                chunks.append([(line, cache) for line in wrapped])
+                num_lines += len(wrapped)
+                if num_lines >= max_lines:
+                    break
+            self.lines = [l for wrapped in reversed(chunks)
+                          for l in wrapped][-max_lines:]
+        height = len(self.lines) * log_line_h
+
+        def render(c):
+            c.fill_rect((0, 0), size=(w.INFO_SIZE, height),
+                        color=to_rgba(BLACK, .3))
+            for i, (text, cache) in enumerate(self.lines):
+                c.draw_text((0, 9 + i * log_line_h), text, align='left',
+                            size=10, face='monospace', cache=cache)
+
+        self.layer.draw(c, (0, w.win_size.y - height), (w.INFO_SIZE, height),
+                        key, render)
 
 
 class ExperienceMeter(Subscriber):
@@ -90,6 +463,7 @@ class ExperienceMeter(Subscriber):
         self.level = 0
         self.current_xp = 0
         self.next_xp = 0
+        self.layer = RetainedLayer()
 
     def on_experience_info(self, level, current_xp, next_xp):
         self.level = level
@@ -98,23 +472,63 @@ class ExperienceMeter(Subscriber):
 
     def on_draw_hud(self, c, w):
         if self.level == 0: return
-        if w.player.is_alive: return
+        if w.player and w.player.is_alive: return
         bar_width = 200
         level_height = 30
-        x = (w.win_size.x - bar_width - level_height) / 2
-        # bar progress
-        bar_progress = bar_width * self.current_xp / self.next_xp
-        c.fill_rect((x, 0), size=(bar_progress, level_height),
-                    color=to_rgba(GREEN, .3))
-        # bar outline
-        c.stroke_rect((x, 0), size=(bar_width, level_height),
-                      width=2, color=to_rgba(GREEN, .7))
-        # current level
         radius = level_height / 2
-        center = (x + bar_width + radius, radius)
-        c.fill_circle(center, radius, color=to_rgba(YELLOW, .8))
-        c.draw_text(center, '%s' % self.level,
-                    align='center', color=BLACK, size=radius)
+
+        def render(c):
+            # bar progress
+            bar_progress = bar_width * self.current_xp / self.next_xp
+            c.fill_rect((0, 0), size=(bar_progress, level_height),
+                        color=to_rgba(GREEN, .3))
+            # bar outline
+            c.stroke_rect((0, 0), size=(bar_width, level_height),
+                          width=2, color=to_rgba(GREEN, .7))
+            # current level
+            center = (bar_width + radius, radius)
+            c.fill_circle(center, radius, color=to_rgba(YELLOW, .8))
+            c.draw_text(center, '%s' % self.level,
+                        align='center', color=BLACK, size=radius)
+
+        x = (w.win_size.x - bar_width - level_height) / 2
+        self.layer.draw(c, (x, 0), (bar_width + level_height, level_height),
+                        (self.level, self.current_xp, self.next_xp), render)
+
+
+class ProfilerOverlay(Subscriber):
+    """
+    Shows the slowest handlers timed by a Profiler.
+    Pressing `expand_key` toggles between the top few and all handlers.
+    """
+
+    def __init__(self, profiler, expand_key=None, collapsed_rows=5):
+        self.profiler = profiler
+        self.expand_key = expand_key
+        self.collapsed_rows = collapsed_rows
+        self.expanded = False
+
+    def on_key_pressed(self, val, char):
+        if val == self.expand_key:
+            self.expanded = not self.expanded
+
+    def on_draw_hud(self, c, w):
+        rows = self.profiler.rows()
+        if not self.expanded:
+            rows = rows[:self.collapsed_rows]
+        line_h = 12
+        lines = ['%-32s %7s %7s %7s' % ('handler', 'calls', 'mean', 'p99')]
+        for sub, event, hist in rows:
+            lines.append('%-32s %7i %6.2fms %6.2fms' % (
+                '%s.%s' % (sub, event[3:]), hist.count,
+                1000 * hist.mean, 1000 * hist.percentile(.99)))
+        top = w.INFO_SIZE + 10  # below the mass graph
+        c.fill_rect((0, top), size=(w.INFO_SIZE * 1.8, len(lines) * line_h + 4),
+                    color=to_rgba(BLACK, .5))
+        for i, text in enumerate(lines):
+            # timings change every frame, do not cache them
+            c.draw_text((2, top + 11 + i * line_h), text, align='left',
+                        size=10, face='monospace', cache=i == 0)
 
 
 class FpsMeter(Subscriber):
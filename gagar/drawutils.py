@@ -1,3 +1,9 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from math import ceil
+
+import cairo
+
 TWOPI = 6.28318530717958
 
 BLACK = (0,0,0)
@@ -30,78 +36,294 @@ def to_rgba(c, a):
     return c[0], c[1], c[2], a
 
 
+def surface_bytes(surface):
+    return surface.get_stride() * surface.get_height()
+
+
+def text_size_bucket(size):
+    """Rounds font sizes, so text of similar size shares text cache entries."""
+    if size < 32:
+        return int(round(size))
+    return int(round(size / 4)) * 4
+
+
+def render_text(c, text, x, y, color, shadow, outline):
+    """Draws the text with its origin at (x, y), font and size already set."""
+    # optionally, draw shadow/outline behind the text
+    if shadow:
+        s_color, (s_dx, s_dy) = shadow
+        c.move_to(x + s_dx, y + s_dy)
+        c.set_source_rgba(*s_color)
+        c.show_text(text)
+
+    if outline:
+        o_color, o_size = outline
+        c.move_to(x, y)
+        c.set_line_width(o_size)
+        c.set_source_rgba(*o_color)
+        c.text_path(text)
+        c.stroke()
+
+    # draw the text itself
+    c.move_to(x, y)
+    c.set_source_rgba(*color)
+    c.text_path(text)
+    c.fill()
+
+
+class TextCache(object):
+    """
+    LRU cache of text rendered into image surfaces,
+    so drawing the same text again only needs one blit.
+    Keeps at most `max_bytes` of surfaces, least recently used text is evicted.
+    """
+
+    def __init__(self, max_bytes=8 * 1024 * 1024, max_size=64):
+        """
+        :param max_size: larger font sizes are not cached, their surfaces
+                         would evict lots of small text
+        """
+        self.max_bytes = max_bytes
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._num_bytes = 0
+        self._measure_context = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def num_bytes(self):
+        return self._num_bytes
+
+    def clear(self):
+        self._entries.clear()
+        self._num_bytes = 0
+
+    def get(self, text, size, face, color, shadow, outline):
+        """
+        Renders the text, or finds it in the cache.
+        Raises UnicodeEncodeError if the text contains invalid chars.
+        :return (surface, x_bearing, y_bearing, width, height, padding)
+        """
+        if shadow:  # offset may be a Vec, which cannot be hashed
+            s_color, s_offset = shadow
+            shadow = tuple(s_color), tuple(s_offset)
+        key = text, size, face, color, shadow, outline
+        entry = self._entries.get(key)
+        if entry:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        entry = self._entries[key] = self._render(*key)
+        self._num_bytes += surface_bytes(entry[0])
+        while self._num_bytes > self.max_bytes and len(self._entries) > 1:
+            _, old_entry = self._entries.popitem(last=False)
+            self._num_bytes -= surface_bytes(old_entry[0])
+        return entry
+
+    def _render(self, text, size, face, color, shadow, outline):
+        if not self._measure_context:
+            self._measure_context = cairo.Context(
+                cairo.ImageSurface(cairo.FORMAT_ARGB32, 1, 1))
+        c = self._measure_context
+        c.select_font_face(face)
+        c.set_font_size(size)
+        x_bearing, y_bearing, text_width, text_height, x_advance, y_advance \
+            = c.text_extents(text)
+
+        # leave room around the text for antialiasing, outline and shadow
+        pad = 1
+        if outline:
+            pad += outline[1] / 2
+        if shadow:
+            s_dx, s_dy = shadow[1]
+            pad += max(abs(s_dx), abs(s_dy))
+        pad = int(ceil(pad))
+
+        surface = cairo.ImageSurface(cairo.FORMAT_ARGB32,
+                                     int(ceil(text_width)) + 2 * pad,
+                                     int(ceil(text_height)) + 2 * pad)
+        c = cairo.Context(surface)
+        c.select_font_face(face)
+        c.set_font_size(size)
+        x, y = pad - x_bearing, pad - y_bearing  # text origin
+        render_text(c, text, x, y, color, shadow, outline)
+
+        return surface, x_bearing, y_bearing, text_width, text_height, pad
+
+
 class Canvas(object):
     """Bundles all drawing methods, providing a useful abstraction layer."""
 
+    text_cache = TextCache()  # shared by all canvases, they only live for one frame
+
     def __init__(self, cairo_context):
         self._cairo_context = cairo_context
+        # when batching: runs of ((is_stroke, color, width), circles),
+        # or a dict of style -> circles when reordering
+        self._batch = None
+
+    @contextmanager
+    def batch(self, reorder=False):
+        """
+        Collects the circles drawn in this block, consecutive circles of the
+        same color, alpha and line width get filled/stroked as one path
+        when the block ends, so the drawing order is kept.
+        Anything else drawn in the block is drawn immediately,
+        below the batched circles.
+        :param reorder: collect all circles of a style into one path,
+                        drawn where that style is first used;
+                        only for circles whose order does not matter
+        """
+        if self._batch is not None:  # nested, outermost block draws
+            yield
+            return
+        self._batch = OrderedDict() if reorder else []
+        try:
+            yield
+        finally:
+            batch, self._batch = self._batch, None
+            self._draw_batch(batch)
+
+    def _add_to_batch(self, style, circle):
+        batch = self._batch
+        if isinstance(batch, list):
+            if batch and batch[-1][0] == style:
+                batch[-1][1].append(circle)
+            else:  # style changed, start a new path
+                batch.append((style, [circle]))
+        else:
+            batch.setdefault(style, []).append(circle)
+
+    def _draw_batch(self, batch):
+        c = self._cairo_context
+        runs = batch.items() if isinstance(batch, dict) else batch
+        for (is_stroke, color, width), circles in runs:
+            if width: c.set_line_width(width)
+            if color: c.set_source_rgba(*color)
+            for x, y, radius in circles:
+                c.new_sub_path()
+                c.arc(x, y, radius, 0, TWOPI)
+            if is_stroke:
+                c.stroke()
+            else:
+                c.fill()
 
     def draw_text(self, pos, text, size=12, face='sans',
                   align=None, anchor_x='left', anchor_y='baseline',
-                  color=WHITE, shadow=None, outline=None):
-        c = self._cairo_context
+                  color=WHITE, shadow=None, outline=None, cache=True):
+        """
+        :param cache: False for text that changes often (timers, stats),
+                      which is drawn directly instead of filling the cache
+        """
+        size = text_size_bucket(size)
+        cache = cache and size <= self.text_cache.max_size
         try:
-            c.select_font_face(face)
-            c.set_font_size(size)
-
-            # align overrides anchors
-            if align:
-                anchor_x = align
-                anchor_y = 'baseline'
-
-            # move text to the correct position
-            x_bearing, y_bearing, text_width, text_height, x_advance, y_advance \
-                = c.text_extents(text)
-            x, y = map(int, pos)
-            x -= x_bearing
-
-            if anchor_x == 'center':
-                x -= text_width // 2
-            elif anchor_x == 'right':
-                x -= text_width
-            elif anchor_x == 'left':
-                pass
-            else:
-                raise ValueError('Invalid anchor_x "%s"' % anchor_x)
-
-            if anchor_y == 'center':
-                y -= y_bearing + text_height // 2
-            elif anchor_y == 'top':
-                y -= y_bearing
-            elif anchor_y == 'bottom':
-                y -= y_bearing + text_height
-            elif anchor_y == 'baseline':
-                pass
+            if cache:
+                surface, x_bearing, y_bearing, text_width, text_height, pad \
+                    = self.text_cache.get(text, size, face,
+                                          color, shadow, outline)
             else:
-                raise ValueError('Invalid anchor_y "%s"' % anchor_y)
-
-            # optionally, draw shadow/outline behind the text
-            if shadow:
-                s_color, s_offset = shadow
-                s_dx, s_dy = s_offset
-                c.move_to(x + s_dx, y + s_dy)
-                c.set_source_rgba(*s_color)
-                c.show_text(text)
-
-            if outline:
-                o_color, o_size = outline
-                c.move_to(x, y)
-                c.set_line_width(o_size)
-                c.set_source_rgba(*o_color)
-                c.text_path(text)
-                c.stroke()
-
-            # draw the text itself
-            c.move_to(x, y)
-            c.set_source_rgba(*color)
-            c.text_path(text)
-            c.fill()
+                c = self._cairo_context
+                c.select_font_face(face)
+                c.set_font_size(size)
+                x_bearing, y_bearing, text_width, text_height, _, _ \
+                    = c.text_extents(text)
         except UnicodeEncodeError:  # tried to display invalid chars
+            return
+
+        # align overrides anchors
+        if align:
+            anchor_x = align
+            anchor_y = 'baseline'
+
+        # move text to the correct position
+        x, y = map(int, pos)
+        x -= x_bearing
+
+        if anchor_x == 'center':
+            x -= text_width // 2
+        elif anchor_x == 'right':
+            x -= text_width
+        elif anchor_x == 'left':
             pass
+        else:
+            raise ValueError('Invalid anchor_x "%s"' % anchor_x)
+
+        if anchor_y == 'center':
+            y -= y_bearing + text_height // 2
+        elif anchor_y == 'top':
+            y -= y_bearing
+        elif anchor_y == 'bottom':
+            y -= y_bearing + text_height
+        elif anchor_y == 'baseline':
+            pass
+        else:
+            raise ValueError('Invalid anchor_y "%s"' % anchor_y)
+
+        if not cache:
+            render_text(self._cairo_context, text, x, y,
+                        color, shadow, outline)
+            return
+
+        # (x, y) is the text origin, the surface starts at the ink's top left
+        self.draw_surface(surface, (round(x + x_bearing - pad),
+                                    round(y + y_bearing - pad)))
+
+    def text_width(self, text, size=12, face='sans'):
+        """Width of the text's ink as draw_text() draws it, without outline."""
+        c = self._cairo_context
+        c.select_font_face(face)
+        c.set_font_size(text_size_bucket(size))
+        try:
+            return c.text_extents(text)[2]
+        except UnicodeEncodeError:  # draw_text() does not draw it either
+            return 0
+
+    def draw_surface(self, surface, pos, scale=1):
+        c = self._cairo_context
+        x, y = pos
+        if scale == 1:
+            c.set_source_surface(surface, x, y)
+            c.rectangle(x, y, surface.get_width(), surface.get_height())
+            c.fill()
+            return
+        c.save()
+        c.translate(x, y)
+        c.scale(scale, scale)
+        c.set_source_surface(surface, 0, 0)
+        c.rectangle(0, 0, surface.get_width(), surface.get_height())
+        c.fill()
+        c.restore()
+
+    def fill_tiled(self, surface, origin, left_top, right_bottom, scale=1):
+        """
+        Fills the rectangle with the surface repeated in all directions,
+        one tile starting at `origin`, scaled by `scale`.
+        """
+        c = self._cairo_context
+        pattern = cairo.SurfacePattern(surface)
+        pattern.set_extend(cairo.EXTEND_REPEAT)
+        matrix = cairo.Matrix()
+        matrix.scale(1 / scale, 1 / scale)
+        matrix.translate(-origin[0], -origin[1])
+        pattern.set_matrix(matrix)
+        left, top = left_top
+        right, bottom = right_bottom
+        c.set_source(pattern)
+        c.rectangle(left, top, right - left, bottom - top)
+        c.fill()
 
     def fill_circle(self, pos, radius, color=None):
         c = self._cairo_context
         x, y = pos
+        if self._batch is not None:
+            self._add_to_batch((False, color, None), (x, y, radius))
+            return
         if color: c.set_source_rgba(*color)
         c.new_sub_path()
         c.arc(x, y, radius, 0, TWOPI)
@@ -110,6 +332,9 @@ class Canvas(object):
     def stroke_circle(self, pos, radius, width=None, color=None):
         c = self._cairo_context
         x, y = pos
+        if self._batch is not None:
+            self._add_to_batch((True, color, width), (x, y, radius))
+            return
         if width: c.set_line_width(width)
         if color: c.set_source_rgba(*color)
         c.new_sub_path()
@@ -164,3 +389,38 @@ class Canvas(object):
         c = self._cairo_context
         c.set_source_rgba(*color)
         c.paint()
+
+
+class RetainedLayer(object):
+    """
+    Offscreen surface that keeps what was drawn into it between frames.
+    It only gets drawn again when its key (e.g. the drawn data) or its size
+    changes, otherwise it is composited as-is.
+    """
+
+    def __init__(self):
+        self.surface = None
+        self.key = None
+        self.renders = 0
+
+    def draw(self, c, pos, size, key, render):
+        """
+        Draws the layer onto the canvas `c` with its top left at `pos`.
+        :param key: when different from last time, render() draws the layer
+                    again, so it has to contain everything render() draws
+        :param render: called with a Canvas for the layer,
+                       with (0, 0) at the layer's top left
+        """
+        width, height = int(ceil(size[0])), int(ceil(size[1]))
+        key = width, height, key
+        if key != self.key:
+            self.key = key
+            self.surface = None
+            if width > 0 and height > 0:
+                self.surface = cairo.ImageSurface(
+                    cairo.FORMAT_ARGB32, width, height)
+                render(Canvas(cairo.Context(self.surface)))
+                self.renders += 1
+        if self.surface:
+            # whole pixels, so the surface does not get blurred
+            c.draw_surface(self.surface, (round(pos[0]), round(pos[1])))
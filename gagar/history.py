@@ -0,0 +1,138 @@
+"""
+What happened to each cell recently: when it was first and last seen,
+when it was split off, and where it moved.
+
+CellHistory keeps one CellRecord per cell, with a fixed number of positions,
+except for food and ejected mass, which are most cells of a world.
+Records are dropped when their cell gets removed or was not seen for a while,
+and the least recently seen ones go first when there are too many,
+so memory stays the same over long sessions.
+"""
+from collections import OrderedDict, deque
+from time import monotonic
+
+from .subscriber import Subscriber
+
+
+class CellRecord(object):
+    __slots__ = ('cid', 'first_seen', 'last_seen', 'split_time', 'trail')
+
+    def __init__(self, cid, now, trail_length):
+        self.cid = cid
+        self.first_seen = self.last_seen = now
+        self.split_time = None  # when it became an own cell, None if never
+        self.trail = deque(maxlen=trail_length)  # (time, x, y), oldest first
+
+    @property
+    def velocity(self):
+        """Movement per second between the last two updates, in world size."""
+        if len(self.trail) < 2:
+            return 0., 0.
+        (t0, x0, y0), (t1, x1, y1) = self.trail[-2], self.trail[-1]
+        dt = t1 - t0
+        if dt <= 0:
+            return 0., 0.
+        return (x1 - x0) / dt, (y1 - y0) / dt
+
+
+class CellHistory(Subscriber):
+    """
+    Records of the cells in one world, fed by its cell events.
+    A record is kept until its cell gets removed or eaten,
+    or for `timeout` seconds after the cell was last updated.
+    """
+
+    def __init__(self, trail_length=32, timeout=30, max_cells=4096):
+        """
+        :param trail_length: positions kept per cell
+        :param timeout: seconds after which a cell that was not updated
+                        is forgotten
+        :param max_cells: records kept at most,
+                          the least recently seen get dropped first,
+                          own cells only when there are no others
+        """
+        self.trail_length = trail_length
+        self.timeout = timeout
+        self.max_cells = max_cells
+        self.records = OrderedDict()  # cid -> CellRecord, last seen last
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, cid):
+        return cid in self.records
+
+    def get(self, cid):
+        """The CellRecord of this cell, None if not known."""
+        return self.records.get(cid)
+
+    def _record(self, cid, now):
+        record = self.records.get(cid)
+        if record is None:
+            # make room first, the new record is not marked as own yet
+            if len(self.records) >= self.max_cells:
+                self._drop_oldest()
+            record = self.records[cid] = CellRecord(cid, now, self.trail_length)
+        else:
+            record.last_seen = now
+            self.records.move_to_end(cid)
+        return record
+
+    def _drop_oldest(self):
+        """
+        Forgets the least recently seen cell that is not an own cell,
+        or the least recently seen own cell if all are.
+        """
+        records = self.records
+        for cid, record in records.items():
+            if record.split_time is None:
+                del records[cid]
+                return
+        records.popitem(last=False)
+
+    def on_own_id(self, cid):
+        now = monotonic()
+        self._record(cid, now).split_time = now
+
+    def on_cell_info(self, cid, x, y, size, name, **_):
+        if not name and (size < 20 or size in (37, 38)) \
+                and cid not in self.records:
+            return  # food or ejected mass, like Cell.is_food/is_ejected_mass
+        now = monotonic()
+        self._record(cid, now).trail.append((now, x, y))
+
+    def on_cell_eaten(self, eater_id, eaten_id):
+        self.records.pop(eaten_id, None)
+
+    def on_cell_removed(self, cid):
+        self.records.pop(cid, None)
+
+    def on_clear_cells(self):
+        self.records.clear()
+
+    # the world gets reset when connecting
+    on_sock_open = on_clear_cells
+
+    def on_world_update_post(self):
+        # records are ordered by last_seen, expired ones are at the front
+        now = monotonic()
+        expired = now - self.timeout
+        records = self.records
+        while records:
+            record = next(iter(records.values()))
+            if record.last_seen >= expired:
+                break
+            del records[record.cid]
+
+
+class OwnIdFeeder(Subscriber):
+    """
+    Passes a client's own ids on to a CellHistory
+    that gets its cell events from somewhere else (e.g. a MergedWorld).
+    """
+
+    def __init__(self, history):
+        self.history = history
+
+    def on_own_id(self, cid):
+        self.history.on_own_id(cid)
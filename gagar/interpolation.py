@@ -0,0 +1,135 @@
+"""
+Smooth movement between world updates.
+
+Cells only move when a world update arrives (about 25 times per second).
+Interpolator remembers the previous and current position and size of each cell
+and blends them by the time since the last update,
+so drawing at a higher frame rate shows smooth movement.
+"""
+from time import monotonic
+
+from agarnet.vec import Vec
+from .subscriber import Subscriber
+
+
+class InterpolatedCell(object):
+    """
+    Stands in for a world cell while drawing,
+    with position and size blended between world updates.
+    Everything else is read from the cell itself.
+    """
+
+    def __init__(self, cell):
+        self.cell = cell
+        self.pos = Vec(*cell.pos)
+        self.size = cell.size
+
+    def __getattr__(self, name):
+        return getattr(self.cell, name)
+
+
+class Interpolator(Subscriber):
+    """
+    Interpolates the cells of one player's world and its camera.
+    When an update is late, movement gets extrapolated
+    for up to `max_extrapolation` seconds.
+    """
+
+    def __init__(self, player, max_extrapolation=.1):
+        self.player = player
+        self.max_extrapolation = max_extrapolation
+
+        # cid -> [prev_x, prev_y, prev_size, x, y, size, update number]
+        self.states = {}
+        self.proxies = {}  # cid -> InterpolatedCell, reused between frames
+        self.update_num = 0  # number of the update currently being received
+        self.update_time = self.prev_update_time = monotonic()
+        self.update_interval = .04  # smoothed time between updates
+
+        self.prev_center = Vec(*player.center)
+        self.center = Vec(*player.center)
+        self.prev_scale = self.scale = player.scale
+
+        # set by frame()
+        self.alpha = 1.  # 0: previous update, 1: last update, >1: extrapolated
+        self.frame_center = Vec(*player.center)
+        self.frame_scale = player.scale
+
+    @property
+    def world(self):
+        return self.player.world
+
+    def on_cell_info(self, cid, x, y, size, **_):
+        state = self.states.get(cid)
+        if state is None:
+            self.states[cid] = [x, y, size, x, y, size, self.update_num]
+        elif state[6] == self.update_num:
+            # several updates were coalesced into one, keep the oldest position
+            state[3:6] = x, y, size
+        else:
+            state[:] = state[3], state[4], state[5], x, y, size, self.update_num
+
+    def on_cell_removed(self, cid):
+        self.states.pop(cid, None)
+        self.proxies.pop(cid, None)
+
+    def on_cell_eaten(self, eater_id, eaten_id):
+        self.on_cell_removed(eaten_id)
+
+    def on_clear_cells(self):
+        self.states.clear()
+        self.proxies.clear()
+
+    # the world gets reset when connecting
+    on_sock_open = on_clear_cells
+
+    def on_world_update_post(self):
+        now = monotonic()
+        self.prev_update_time, self.update_time = self.update_time, now
+        interval = min(.25, max(.01, now - self.prev_update_time))
+        self.update_interval = .8 * self.update_interval + .2 * interval
+        self.update_num += 1
+
+        self.prev_center.set(*self.frame_center)
+        self.center.set(*self.player.center)
+        self.prev_scale, self.scale = self.frame_scale, self.player.scale
+
+    def is_animating(self, now=None):
+        """True while cells may still move without a new update."""
+        if now is None:
+            now = monotonic()
+        return now < self.update_time + self.update_interval \
+            + self.max_extrapolation
+
+    def frame(self, now=None):
+        """Prepare blending for a new frame, call once before drawing."""
+        if now is None:
+            now = monotonic()
+        interval = self.update_interval
+        alpha = (now - self.update_time) / interval
+        self.alpha = max(0., min(alpha, 1. + self.max_extrapolation / interval))
+
+        # camera does not extrapolate, that would make it overshoot
+        camera_alpha = min(self.alpha, 1.)
+        prev, cur = self.prev_center, self.center
+        self.frame_center.set(prev.x + (cur.x - prev.x) * camera_alpha,
+                              prev.y + (cur.y - prev.y) * camera_alpha)
+        self.frame_scale = self.prev_scale \
+            + (self.scale - self.prev_scale) * camera_alpha
+
+    def cell(self, cell):
+        """The InterpolatedCell for drawing this cell in the current frame."""
+        cid = cell.cid
+        proxy = self.proxies.get(cid)
+        if proxy is None or proxy.cell is not cell:
+            proxy = self.proxies[cid] = InterpolatedCell(cell)
+        state = self.states.get(cid)
+        if state and state[6] == self.update_num - 1:  # moved in last update
+            prev_x, prev_y, prev_size, x, y, size, _ = state
+            a = self.alpha
+            proxy.pos.set(prev_x + (x - prev_x) * a, prev_y + (y - prev_y) * a)
+            proxy.size = prev_size + (size - prev_size) * a
+        else:
+            proxy.pos.set(*cell.pos)
+            proxy.size = cell.size
+        return proxy
@@ -0,0 +1,83 @@
+"""
+The subscribers that draw the world, shared by GtkControl and the benchmark.
+Does not need GTK, key codes are the X11 keysyms GTK uses.
+"""
+from .cell_index import CellIndex
+from .draw_background import *
+from .draw_cells import *
+from .draw_hud import *
+from .drawutils import WHITE
+from .history import CellHistory, OwnIdFeeder
+from .interpolation import Interpolator
+from .skins import CellSkins
+from .subscriber import KeyToggler
+from .threat import ThreatAnalysis
+
+KEY_F1 = 0xffbe
+KEY_F2 = 0xffbf
+KEY_F3 = 0xffc0
+KEY_F4 = 0xffc1
+KEY_F5 = 0xffc2
+
+
+def sub_draw_layers(multi_sub, client, profiler=None, merged=None,
+                    log_path=None):
+    """
+    Subscribes the world drawing subscribers of `client` to `multi_sub`.
+    Order is important, first subscriber gets called first.
+    :param profiler: show the handler timings of this Profiler
+    :param merged: draw the cells of this MergedWorld instead of the client's
+    :param log_path: also write the log messages to this file
+    :return (cell_index, interpolator) for the WorldView
+    """
+
+    def key(keycode, *subs, disabled=False):
+        # subscribe all these subscribers, toggle them when key is pressed
+        if isinstance(keycode, str): keycode = ord(keycode)
+        multi_sub.sub(KeyToggler(keycode, *subs, disabled=disabled))
+
+    if merged:
+        cell_index = merged.subscriber.sub(CellIndex(merged.world))
+        interpolator = merged.subscriber.sub(Interpolator(merged.player))
+        threats = merged.subscriber.sub(ThreatAnalysis(merged.player))
+        history = merged.subscriber.sub(CellHistory())
+        # own ids only come from the focused client
+        multi_sub.sub(OwnIdFeeder(history))
+    else:
+        cell_index = multi_sub.sub(CellIndex(client.player.world))
+        interpolator = multi_sub.sub(Interpolator(client.player))
+        threats = multi_sub.sub(ThreatAnalysis(client.player))
+        history = multi_sub.sub(CellHistory())
+
+    # background
+    key(KEY_F2, SolidBackground())
+    key(KEY_F2, SolidBackground(WHITE), disabled=True)
+    key('b', WorldBorderDrawer())
+    key('g', GridDrawer())
+
+    multi_sub.sub(CellsDrawer())
+
+    # cell overlay
+    key('k', CellSkins())
+    key('n', CellNames())
+    key('i',
+        CellHostility(threats),
+        CellMasses(),
+        RemergeTimes(client, history),
+        ForceFields(threats),
+    )
+    key('m', MovementLines(history))
+
+    # HUD
+    key(KEY_F1,
+        Minimap(),
+        Leaderboard(),
+        # ExperienceMeter(),
+        Logger(client, log_path=log_path),
+        MassGraph(client),
+    )
+    key(KEY_F3, FpsMeter(50), disabled=True)
+    if profiler:
+        key(KEY_F4, ProfilerOverlay(profiler, expand_key=KEY_F5))
+
+    return cell_index, interpolator
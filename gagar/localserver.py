@@ -0,0 +1,382 @@
+"""
+Local stand-in agar server for load testing the client, without any outside network.
+
+Speaks the protocol subset agarnet's Client uses: handshake and token,
+world rect, world updates, leaderboard and own id.
+Simulates a configurable number of cells at a configurable tick rate,
+optionally with artificial latency and bursts of packets.
+
+    python -m gagar.localserver --cells 5000 --tick-rate 100
+    gagar 127.0.0.1:8765 anytoken
+"""
+import argparse
+import asyncio
+import base64
+from collections import deque
+import hashlib
+import random
+import struct
+
+WS_GUID = b'258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+# server to client opcodes
+WORLD_UPDATE = 16
+OWN_ID = 32
+LEADERBOARD_NAMES = 49
+WORLD_RECT = 64
+
+# client to server opcodes
+RESPAWN = 0
+TARGET = 16
+
+VIRUS_COLOR = (51, 255, 51)
+
+
+def pack_str16(text):
+    return text.encode('utf-16-le') + b'\0\0'
+
+
+def unpack_str16(data):
+    end = 0
+    while end + 1 < len(data) and data[end:end + 2] != b'\0\0':
+        end += 2
+    return data[:end].decode('utf-16-le', errors='replace')
+
+
+class SimCell(object):
+    __slots__ = ('cid', 'x', 'y', 'size', 'color', 'name', 'is_virus',
+                 'target_x', 'target_y')
+
+    def __init__(self, cid, x, y, size, color, name='', is_virus=False):
+        self.cid = cid
+        self.x = x
+        self.y = y
+        self.size = size
+        self.color = color
+        self.name = name
+        self.is_virus = is_virus
+        self.target_x = x
+        self.target_y = y
+
+    def pack(self):
+        r, g, b = self.color
+        return struct.pack('<IiihBBBB', self.cid, int(self.x), int(self.y),
+                           int(self.size), r, g, b, int(self.is_virus)) \
+            + pack_str16(self.name)
+
+
+class SimWorld(object):
+    """Cells that move around randomly, and get eaten and respawned now and then."""
+
+    def __init__(self, num_cells, size=11180, bots=.05, viruses=.01,
+                 eat_rate=.002, seed=None):
+        self.size = size
+        self.rng = random.Random(seed)
+        self.cells = {}
+        self.movers = []  # cids of bots and players, which move every tick
+        self.next_cid = 1
+        self.eat_rate = eat_rate
+        for _ in range(num_cells):
+            r = self.rng.random()
+            if r < viruses:
+                self.add_cell(100, VIRUS_COLOR, is_virus=True)
+            elif r < viruses + bots:
+                cell = self.add_cell(
+                    int(30 + 200 * self.rng.random() ** 3), self.random_color(),
+                    name='bot %i' % self.rng.randint(1, 999))
+                self.movers.append(cell.cid)
+            else:
+                self.add_cell(self.rng.randint(10, 14), self.random_color())
+
+    def random_color(self):
+        return tuple(self.rng.randint(0, 255) for _ in range(3))
+
+    def add_cell(self, size, color, name='', is_virus=False, pos=None):
+        x, y = pos or (self.rng.uniform(0, self.size), self.rng.uniform(0, self.size))
+        cell = SimCell(self.next_cid, x, y, size, color, name, is_virus)
+        self.cells[cell.cid] = cell
+        self.next_cid += 1
+        return cell
+
+    def step(self, dt):
+        """
+        Moves all bots and players, eats and respawns some food.
+        :param dt: seconds since the last step
+        :return (list of (eater, eaten) cids, list of changed cells)
+        """
+        rng = self.rng
+        changed = []
+        for cid in self.movers:
+            cell = self.cells[cid]
+            if cell.name.startswith('bot ') and rng.random() < .02:
+                cell.target_x = rng.uniform(0, self.size)
+                cell.target_y = rng.uniform(0, self.size)
+            dx, dy = cell.target_x - cell.x, cell.target_y - cell.y
+            dist = (dx * dx + dy * dy) ** .5
+            speed = min(dist, 2000 / cell.size ** .5 * dt)
+            if speed > .5:
+                cell.x += dx / dist * speed
+                cell.y += dy / dist * speed
+                changed.append(cell)
+
+        eaten = []
+        num_eaten = int(self.eat_rate * len(self.cells))
+        food = [cid for cid in rng.sample(list(self.cells), num_eaten)
+                if not self.cells[cid].name and not self.cells[cid].is_virus]
+        for cid in food:
+            eater = rng.choice(self.movers) if self.movers else cid
+            eaten.append((eater, cid))
+            del self.cells[cid]
+            changed.append(self.add_cell(rng.randint(10, 14), self.random_color()))
+        return eaten, changed
+
+    def leaderboard(self):
+        players = sorted((self.cells[cid] for cid in self.movers),
+                         key=lambda cell: -cell.size)
+        return [(cell.cid, cell.name) for cell in players[:10]]
+
+
+def world_update_packet(eaten, cells, removed=()):
+    parts = [struct.pack('<BH', WORLD_UPDATE, len(eaten))]
+    parts.extend(struct.pack('<II', eater, cid) for eater, cid in eaten)
+    parts.extend(cell.pack() for cell in cells)
+    parts.append(struct.pack('<II', 0, len(removed)))
+    parts.extend(struct.pack('<I', cid) for cid in removed)
+    return b''.join(parts)
+
+
+def leaderboard_packet(leaderboard):
+    parts = [struct.pack('<BI', LEADERBOARD_NAMES, len(leaderboard))]
+    for cid, name in leaderboard:
+        parts.append(struct.pack('<I', cid) + pack_str16(name))
+    return b''.join(parts)
+
+
+def world_rect_packet(size):
+    return struct.pack('<Bdddd', WORLD_RECT, 0, 0, size, size)
+
+
+class Connection(object):
+    """One websocket client, sending with artificial latency and bursts."""
+
+    def __init__(self, server, reader, writer):
+        self.server = server
+        self.reader = reader
+        self.writer = writer
+        self.own_cell = None
+        self.sent_world = False  # got the full world yet
+        self.held = []  # packets held back for the next burst
+        self.delayed = deque()  # packets waiting for the latency
+        self.closed = False
+
+    async def handshake(self):
+        request = await self.reader.readuntil(b'\r\n\r\n')
+        key = None
+        for line in request.split(b'\r\n'):
+            name, _, value = line.partition(b':')
+            if name.strip().lower() == b'sec-websocket-key':
+                key = value.strip()
+        if not key:
+            self.writer.write(b'HTTP/1.1 400 Bad Request\r\n\r\n')
+            return False
+        accept = base64.b64encode(hashlib.sha1(key + WS_GUID).digest())
+        self.writer.write(b'HTTP/1.1 101 Switching Protocols\r\n'
+                          b'Upgrade: websocket\r\n'
+                          b'Connection: Upgrade\r\n'
+                          b'Sec-WebSocket-Accept: ' + accept + b'\r\n\r\n')
+        return True
+
+    async def read_frame(self):
+        """:return (opcode, payload)"""
+        head = await self.reader.readexactly(2)
+        opcode = head[0] & 0x0f
+        masked = head[1] & 0x80
+        length = head[1] & 0x7f
+        if length == 126:
+            length, = struct.unpack('>H', await self.reader.readexactly(2))
+        elif length == 127:
+            length, = struct.unpack('>Q', await self.reader.readexactly(8))
+        mask = await self.reader.readexactly(4) if masked else None
+        payload = await self.reader.readexactly(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return opcode, payload
+
+    def write_frame(self, payload, opcode=2):
+        length = len(payload)
+        if length < 126:
+            head = struct.pack('>BB', 0x80 | opcode, length)
+        elif length < 1 << 16:
+            head = struct.pack('>BBH', 0x80 | opcode, 126, length)
+        else:
+            head = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+        self.writer.write(head + payload)
+
+    def send(self, packet, hold=False):
+        """Sends after the configured latency; held packets wait for flush()."""
+        if hold:
+            self.held.append(packet)
+            return
+        latency = self.server.latency
+        if latency:
+            loop = asyncio.get_event_loop()
+            # timers with equal deadlines may run in any order,
+            # so each one writes the oldest delayed packet instead of its own
+            self.delayed.append(packet)
+            loop.call_later(latency, self._write_delayed)
+        else:
+            self._write(packet)
+
+    def flush(self):
+        held, self.held = self.held, []
+        for packet in held:
+            self.send(packet)
+
+    def _write_delayed(self):
+        self._write(self.delayed.popleft())
+
+    def _write(self, packet):
+        if not self.closed:
+            self.write_frame(packet)
+
+    def on_packet(self, data):
+        if not data:
+            return
+        opcode = data[0]
+        if opcode == RESPAWN:
+            self.respawn(unpack_str16(data[1:]))
+        elif opcode == TARGET and self.own_cell:
+            if len(data) >= 17:  # doubles in some protocol versions
+                x, y = struct.unpack_from('<dd', data, 1)
+            else:
+                x, y = struct.unpack_from('<ii', data, 1)
+            self.own_cell.target_x, self.own_cell.target_y = x, y
+        # handshake, token, split, shoot, spectate: nothing to simulate
+
+    def respawn(self, nick):
+        world = self.server.world
+        if self.own_cell and self.own_cell.cid in world.cells:
+            return  # still alive
+        self.own_cell = world.add_cell(50, world.random_color(), name=nick or 'player')
+        world.movers.append(self.own_cell.cid)
+        self.server.spawned.append(self.own_cell)
+        self.send(struct.pack('<BI', OWN_ID, self.own_cell.cid))
+
+    def close(self):
+        self.closed = True
+        world = self.server.world
+        if self.own_cell and self.own_cell.cid in world.cells:
+            del world.cells[self.own_cell.cid]
+            world.movers.remove(self.own_cell.cid)
+            self.server.removed.append(self.own_cell.cid)
+        self.writer.close()
+
+
+class LocalServer(object):
+    def __init__(self, world, tick_rate=25, latency=0, burst=1):
+        """
+        :param latency: seconds to delay every packet
+        :param burst: send world updates in bursts of this many
+        """
+        self.world = world
+        self.tick_rate = tick_rate
+        self.latency = latency
+        self.burst = burst
+        self.connections = []
+        self.spawned = []  # cells of players that spawned since the last tick
+        self.removed = []  # cids removed since the last tick
+        self.tick_num = 0
+
+    async def handle(self, reader, writer):
+        conn = Connection(self, reader, writer)
+        try:
+            if not await conn.handshake():
+                return
+            self.connections.append(conn)
+            conn.send(world_rect_packet(self.world.size))
+            while True:
+                opcode, payload = await conn.read_frame()
+                if opcode == 8:  # close
+                    conn.write_frame(payload[:2], opcode=8)
+                    break
+                elif opcode == 9:  # ping
+                    conn.write_frame(payload, opcode=10)
+                elif opcode in (1, 2):
+                    conn.on_packet(payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            if conn in self.connections:
+                self.connections.remove(conn)
+            conn.close()
+
+    async def run_ticks(self):
+        loop = asyncio.get_event_loop()
+        interval = 1 / self.tick_rate
+        next_tick = loop.time()
+        while True:
+            self.tick()
+            next_tick += interval
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+
+    def tick(self):
+        world = self.world
+        eaten, changed = world.step(1 / self.tick_rate)
+        changed.extend(self.spawned)
+        removed, self.removed = self.removed, []
+        self.spawned = []
+        self.tick_num += 1
+        send_leaderboard = self.tick_num % max(1, round(self.tick_rate)) == 0
+        update = None
+        for conn in list(self.connections):
+            if not conn.sent_world:
+                conn.sent_world = True
+                conn.send(world_update_packet([], list(world.cells.values())), hold=True)
+            else:
+                if update is None:
+                    update = world_update_packet(eaten, changed, removed)
+                conn.send(update, hold=True)
+            if send_leaderboard:  # about once per second
+                conn.send(leaderboard_packet(world.leaderboard()), hold=True)
+            if self.tick_num % self.burst == 0:
+                conn.flush()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Local stand-in agar server for load testing gagar.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--cells', type=int, default=2000)
+    parser.add_argument('--bots', type=float, default=.05,
+                        help='fraction of cells that are moving players')
+    parser.add_argument('--viruses', type=float, default=.01)
+    parser.add_argument('--world-size', type=float, default=11180)
+    parser.add_argument('--tick-rate', type=float, default=25,
+                        help='world updates per second')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='milliseconds to delay every packet')
+    parser.add_argument('--burst', type=int, default=1,
+                        help='send world updates in bursts of this many')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    world = SimWorld(args.cells, size=args.world_size, bots=args.bots,
+                     viruses=args.viruses, seed=args.seed)
+    server = LocalServer(world, tick_rate=args.tick_rate,
+                         latency=args.latency / 1000, burst=max(1, args.burst))
+
+    async def serve():
+        await asyncio.start_server(server.handle, args.host, args.port)
+        print('Serving %i cells at %s:%i, %g updates per second'
+              % (len(world.cells), args.host, args.port, args.tick_rate))
+        await server.run_ticks()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
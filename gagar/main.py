@@ -1,3 +1,5 @@
+import atexit
+from concurrent.futures import ThreadPoolExecutor
 import random
 import sys
 
@@ -6,13 +8,19 @@ gi.require_version('Gtk', '3.0')
 from gi.repository import Gtk, GLib, Gdk
 
 from agarnet.client import Client
-from agarnet.utils import special_names, get_party_address, find_server
+from agarnet.utils import special_names
+from .connection import PARTY, PreparedSocket, backoff_delay, \
+    open_connection, socket_readable
 from .draw_hud import *
 from .draw_cells import *
 from .draw_background import *
 from .drawutils import *
+from .layers import sub_draw_layers
+from .merged import MergedWorld
+from .profiling import Profiler
+from .replay import Recorder, RecordingSocket, Replayer
 from .skins import CellSkins
-from .subscriber import MultiSubscriber, Subscriber
+from .subscriber import Coalescer, KeyToggler, MultiSubscriber, Subscriber
 from .window import WorldViewer
 
 
@@ -58,116 +66,255 @@ class NativeControl(Subscriber):
             self.client.send_explode()
 
 
-def format_log(lines, width, indent='  '):
-    width = int(width)
-    for l in lines:
-        ind = ''
-        while len(l) > len(ind):
-            yield l[:width]
-            ind = indent
-            l = ind + l[width:]
+class GtkConnection(object):
+    """
+    Connects a client without blocking the GTK main loop,
+    and reconnects with exponential backoff when the connection fails or closes.
+    Discovery and the websocket handshake run in a background thread,
+    the connected socket is handed back to the main loop and watched there.
+    """
 
-
-class Logger(Subscriber):
-    def __init__(self, client):
+    def __init__(self, client, recorder=None, min_delay=.5, max_delay=30.,
+                 max_batch=64):
+        """
+        :param recorder: record all frames received over any connection
+        :param max_batch: most frames to process per main loop wakeup
+        """
         self.client = client
-        self.log_msgs = []
-        self.leader_best = 11 # outside leaderboard, to show first msg on >=10
-
-    def on_log_msg(self, msg, update=0, tag='[LOG]'):
+        self.recorder = recorder
+        self.max_batch = max_batch
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.address = self.token = None
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.attempt = 0  # failed attempts since the last successful one
+        self.generation = 0  # ignore results of attempts from before this one
+        self.watch_ids = []
+        self.retry_id = None
+        self.auto_reconnect = True
+
+    def connect(self, address=None, token=None):
         """
-        Updates last `update` msgs with new data.
-        Compares first 5 chars or up to first space.
-        Set update=0 for no updating.
+        Starts connecting in the background, dropping any current connection.
+        :param address: None to find any server, also on each reconnect
         """
-        first_space = msg.index(' ') if ' ' in msg else 5
-        for i, log_msg in enumerate(reversed(
-                self.log_msgs[-update:] if update else [])):
-            if msg[:first_space] == log_msg[:first_space]:
-                self.log_msgs[-i - 1] = msg
-                break
-        else:
-            self.log_msgs.append(msg)
-            try:
-                print(tag, msg)
-            except UnicodeEncodeError:
-                pass
-
-    def on_update_msg(self, msg, update=9):
-        self.on_log_msg(msg=msg, update=update)
-
-    def on_connect_error(self, msg):
-        self.on_log_msg(msg, tag='[ERROR]')
-
-    on_message_error = on_connect_error
-
-    def on_sock_open(self):
-        self.on_update_msg('Connected to %s' % self.client.address)
-        self.on_update_msg('Token: %s' % self.client.server_token)
-
-    def on_world_rect(self, **kwargs):
-        self.on_update_msg('World is from %(left)i:%(top)i to %(right)i:%(bottom)i' % kwargs)
-
-    def on_server_version(self, number, text):
-        self.on_log_msg('Server version %s from %s' % (number, text))
-
-    def on_cell_eaten(self, eater_id, eaten_id):
-        player = self.client.player
-        if eaten_id in player.own_ids:
-            name = 'Someone'
-            if eater_id in player.world.cells:
-                name = '"%s"' % player.world.cells[eater_id].name
-            what = 'killed' if len(player.own_ids) <= 1 else 'ate'
-            msg = '%s %s me!' % (name, what)
-            self.on_update_msg(msg)
+        self.address, self.token = address, token
+        self.attempt = 0
+        self.auto_reconnect = True
+        self.drop()
+        self.start()
+
+    def close(self):
+        """Disconnects, and stops reconnecting."""
+        self.auto_reconnect = False
+        self.drop()
+        self.executor.shutdown(wait=False)
+
+    def drop(self):
+        self.generation += 1
+        if self.retry_id is not None:
+            GLib.source_remove(self.retry_id)
+            self.retry_id = None
+        self.unwatch()
+        if self.client.connected:
+            self.client.disconnect()
 
-    def on_world_update_post(self):
-        player = self.client.player
-        x, y = player.center
-        self.on_update_msg('Mass: %i Pos: (%.2f %.2f)' % (player.total_mass, x, y))
+    def start(self):
+        self.generation += 1
+        generation = self.generation
+        self.client.subscriber.on_update_msg(
+            'Connecting to %s' % (self.address or 'any server'))
+        future = self.executor.submit(open_connection, self.address, self.token)
+        future.add_done_callback(
+            lambda f: GLib.idle_add(self.on_opened, f, generation))
 
-    def on_own_id(self, cid):
-        if len(self.client.player.own_ids) == 1:
-            self.on_log_msg('Respawned as %s' % self.client.player.nick)
+    def on_opened(self, future, generation):
+        try:
+            address, token, ws = future.result()
+        except Exception as e:
+            if generation == self.generation:
+                self.on_closed('Connecting failed: %s' % e)
+            return False
+        if generation != self.generation:  # connect() or close() got called since
+            ws.close()
+            return False
+
+        sock = PreparedSocket(ws)
+        if self.recorder:
+            sock = RecordingSocket(sock, self.recorder)
+        self.client.ws = sock
+        try:
+            connected = self.client.connect(address, token)
+        except Exception as e:  # server closed the socket meanwhile
+            if self.client.connected:
+                self.client.disconnect()
+            else:
+                ws.close()
+            self.on_closed('Handshake failed: %s' % e)
+            return False
+        if connected:
+            self.attempt = 0
+            self.watch()
         else:
-            self.on_update_msg('Split into %i cells' % len(self.client.player.own_ids))
-
-    def on_leaderboard_names(self, leaderboard):
-        if not self.client.player.own_ids:
+            self.on_closed('Handshake failed')
+        return False  # do not call again
+
+    def watch(self):
+        # watch client's websocket in GTK main loop
+        ws = self.client.ws
+        self.watch_ids = [
+            GLib.io_add_watch(ws, GLib.IO_IN, self.on_readable),
+            GLib.io_add_watch(ws, GLib.IO_ERR, self.on_error),
+            GLib.io_add_watch(ws, GLib.IO_HUP, self.on_hangup),
+        ]
+
+    def unwatch(self):
+        for watch_id in self.watch_ids:
+            GLib.source_remove(watch_id)
+        self.watch_ids = []
+
+    def on_readable(self, ws, condition):
+        # process all frames that already arrived, in order,
+        # but the subscribers' post-update work only once
+        client = self.client
+        batch = client.subscriber = Coalescer(client.subscriber)
+        try:
+            for _ in range(self.max_batch):
+                client.on_message()
+                if not client.connected or not socket_readable(client.ws):
+                    break
+        finally:
+            client.subscriber = batch.subscriber
+            batch.flush()
+        if not client.connected:  # closed while receiving
+            self.on_closed('Connection closed')
+        return True  # removed by on_closed() when closed
+
+    def on_error(self, ws, condition):
+        self.client.subscriber.on_sock_error()
+        self.client.disconnect()
+        self.on_closed('Connection error')
+        return True
+
+    def on_hangup(self, ws, condition):
+        self.client.disconnect()
+        self.on_closed('Connection closed by server')
+        return True
+
+    def on_closed(self, reason):
+        self.unwatch()
+        if not self.auto_reconnect:
             return
-        our_cid = min(c.cid for c in self.client.player.own_cells)
-        for rank, (cid, name) in enumerate(leaderboard):
-            if cid == our_cid:
-                rank += 1  # start at rank 1
-                self.leader_best = min(rank, self.leader_best)
-                msg = 'Leaderboard: %i. (best: %i.)' % (rank, self.leader_best)
-                self.on_update_msg(msg)
-
-    def on_draw_hud(self, c, w):
-        # scrolling log
-        log_line_h = 12
-        log_char_w = 6  # seems to work with my font
-
-        log = list(format_log(self.log_msgs, w.INFO_SIZE / log_char_w))
-        num_log_lines = min(len(log), int(w.INFO_SIZE / log_line_h))
-
-        y_start = w.win_size.y - num_log_lines*log_line_h + 9
-
-        c.fill_rect((0, w.win_size.y - num_log_lines*log_line_h),
-                    size=(w.INFO_SIZE, num_log_lines*log_line_h),
-                    color=to_rgba(BLACK, .3))
-
-        for i, text in enumerate(log[-num_log_lines:]):
-            c.draw_text((0, y_start + i*log_line_h), text,
-                        align='left', size=10, face='monospace')
-
+        delay = backoff_delay(self.attempt, self.min_delay, self.max_delay)
+        self.attempt += 1
+        self.client.subscriber.on_connect_error(
+            '%s, reconnecting in %.1fs' % (reason, delay))
+        self.retry_id = GLib.timeout_add(int(delay * 1000), self.retry)
+
+    def retry(self):
+        self.retry_id = None
+        self.start()
+        return False  # do not call again
+
+
+class GtkWorkerConnection(object):
+    """
+    Runs the connection of a client in a worker process,
+    polled from the GTK main loop for new world snapshots.
+    Reconnecting with backoff is done by the worker,
+    a worker that dies gets restarted with backoff.
+    """
+
+    def __init__(self, client, poll_interval=5, reap_interval=100,
+                 min_delay=.5, max_delay=30.):
+        """
+        :param poll_interval: milliseconds between checks for new snapshots
+        :param reap_interval: milliseconds between checks
+                              whether stopped workers quit
+        """
+        # shared memory needs Python 3.8, only import it when used
+        from .worker import ConnectionWorker
+        self.client = client
+        self.poll_interval = poll_interval
+        self.reap_interval = reap_interval
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.address = self.token = None
+        self.worker = ConnectionWorker(client)
+        self.poll_id = self.retry_id = self.reap_id = None
+        self.attempt = 0  # worker restarts since it last connected
+
+    def connect(self, address=None, token=None):
+        """
+        Starts a new worker, stopping the current one.
+        :param address: None to find any server, also on each reconnect
+        """
+        self.close()
+        self.address, self.token = address, token
+        self.client.subscriber.on_update_msg(
+            'Connecting to %s in a worker process' % (address or 'any server'))
+        self.attempt = 0
+        self.start()
+
+    def start(self):
+        self.worker.start(self.address, self.token)
+        self.poll_id = GLib.timeout_add(self.poll_interval, self.poll)
+
+    def close(self):
+        if self.poll_id is not None:
+            GLib.source_remove(self.poll_id)
+            self.poll_id = None
+        if self.retry_id is not None:
+            GLib.source_remove(self.retry_id)
+            self.retry_id = None
+        self.worker.stop()
+        self.reap()
+
+    def poll(self):
+        if self.worker.poll():
+            if self.client.connected:
+                self.attempt = 0
+            return True  # keep polling
+        # the worker died, it already reported why
+        self.poll_id = None
+        self.reap()
+        delay = backoff_delay(self.attempt, self.min_delay, self.max_delay)
+        self.attempt += 1
+        self.client.subscriber.on_update_msg(
+            'Restarting the worker process in %.1fs' % delay)
+        self.retry_id = GLib.timeout_add(int(delay * 1000), self.retry)
+        return False  # do not call again
+
+    def retry(self):
+        self.retry_id = None
+        self.start()
+        return False  # do not call again
+
+    def reap(self):
+        """Keeps reaping stopped workers in the background until all quit."""
+        if self.reap_id is None and self.worker.reap():
+            self.reap_id = GLib.timeout_add(self.reap_interval, self.reaping)
+
+    def reaping(self):
+        if self.worker.reap():
+            return True  # keep checking
+        self.reap_id = None
+        return False
+
+
+def gtk_replay(replayer):
+    # feed the recording to the client from the GTK main loop
+    def feed():
+        delay = replayer.feed()
+        if delay is None:
+            print('Replay finished')
+        elif delay > 0:
+            GLib.timeout_add(int(delay * 1000), feed)
+        else:
+            GLib.idle_add(feed)
+        return False  # rescheduled above
 
-def gtk_watch_client(client):
-    # watch client's websocket in GTK main loop
-    # `or True` is for always returning True to keep watching
-    GLib.io_add_watch(client.ws, GLib.IO_IN, lambda ws, _: client.on_message() or True)
-    GLib.io_add_watch(client.ws, GLib.IO_ERR, lambda ws, _: client.subscriber.on_sock_error() or True)
-    GLib.io_add_watch(client.ws, GLib.IO_HUP, lambda ws, _: client.disconnect() or True)
+    GLib.idle_add(feed)
 
 
 def gtk_main_loop():
@@ -177,25 +324,23 @@ def gtk_main_loop():
     Gtk.main()
 
 
-class KeyToggler(MultiSubscriber):
-    def __init__(self, key, *subs, disabled=False):
-        super(KeyToggler, self).__init__(*subs)
-        self.toggle_key = key
-        self.enabled = not disabled
-
-    def __getattr__(self, func_name):
-        if self.enabled and func_name[:3] == 'on_':
-            return MultiSubscriber.__getattr__(self, func_name)
-        return lambda *_, **__: None
-
-    def on_key_pressed(self, val, char):
-        if val == self.toggle_key:
-            self.enabled = not self.enabled
-        self.__getattr__('on_key_pressed')(val, char)
-
-
 class GtkControl(Subscriber):
-    def __init__(self, address, token=None, nick=None):
+    def __init__(self, address, token=None, nick=None,
+                 max_fps=60, battery_fps=30, profile_path=None,
+                 record_path=None, replay_path=None, replay_speed=1.,
+                 num_connections=1, use_workers=False, log_path=None):
+        """
+        :param profile_path: time all handlers, dump the timings here
+                             on exit and when pressing F6
+        :param record_path: record all received frames to this file
+        :param replay_path: replay this recording instead of connecting
+        :param replay_speed: 1 for real time, 0 for as fast as possible
+        :param num_connections: connect this many clients, all drawn
+                                as one world, Tab cycles the focused one
+        :param use_workers: run each connection in a worker process,
+                            cannot be recorded
+        :param log_path: append all log messages to this file
+        """
         if nick is None: nick = random.choice(special_names)
 
         # connect the subscribers
@@ -203,71 +348,123 @@ class GtkControl(Subscriber):
 
         self.multi_sub = MultiSubscriber(self)
 
-        def key(keycode, *subs, disabled=False):
-            # subscribe all these subscribers, toggle them when key is pressed
-            if isinstance(keycode, str): keycode = ord(keycode)
-            self.multi_sub.sub(KeyToggler(keycode, *subs, disabled=disabled))
-
-        self.client = client = Client(self.multi_sub)
+        self.merged = None
+        if num_connections > 1:
+            # updates of several clients in one main loop iteration
+            # get drawn as one merged update
+            self.merged = MergedWorld(num_connections, self.multi_sub,
+                                      schedule_post=GLib.idle_add)
+            self.clients = self.merged.clients
+            self.client = client = self.merged.focus
+        else:
+            self.client = client = Client(self.multi_sub)
+            self.clients = [client]
 
         self.multi_sub.sub(NativeControl(client))
 
-        # background
-        key(Gdk.KEY_F2, SolidBackground())
-        key(Gdk.KEY_F2, SolidBackground(WHITE), disabled=True)
-        # key('b', WorldBorderDrawer())
-        # key('g', GridDrawer())
-
-        self.multi_sub.sub(CellsDrawer())
-
-        # cell overlay
-        key('k', CellSkins())
-        key('n', CellNames())
-        key('i',
-            CellHostility(),
-            CellMasses(),
-            RemergeTimes(client),
-            ForceFields(),
-        )
-        key('m', MovementLines())
-
-        # HUD
-        key(Gdk.KEY_F1,
-            # Minimap(),
-            Leaderboard(),
-            # ExperienceMeter(),
-            Logger(client),
-            MassGraph(client),
-        )
-        key(Gdk.KEY_F3, FpsMeter(50), disabled=True)
-
-        client.player.nick = nick
-
-        try:
-            client.connect(address, token)
-        except ConnectionResetError:
-            # sometimes connection gets closed on first attempt
-            print('Connection got closed on first attempt, retrying')
-            client.connect(address, token)
-
-        gtk_watch_client(client)
-
-        self.world_viewer = wv = WorldViewer(client.world)
+        self.profiler = Profiler() if profile_path else None
+        self.profile_path = profile_path
+        cell_index, interpolator = sub_draw_layers(
+            self.multi_sub, client, profiler=self.profiler, merged=self.merged,
+            log_path=log_path)
+        if self.merged:
+            self.merged.subscriber.sub(self)  # redraw on any client's update
+        if self.profiler:
+            self.multi_sub.set_profiler(self.profiler)
+            if self.merged:
+                self.merged.subscriber.set_profiler(self.profiler)
+                # the clients dispatch the focused client's events themselves,
+                # from their own flattened handler lists
+                for c in self.clients:
+                    c.subscriber.set_profiler(self.profiler)
+            atexit.register(self.profiler.dump, profile_path)
+
+        for c in self.clients:
+            c.player.nick = nick
+
+        self.replayer = None
+        self.connections = []
+        if replay_path:
+            self.replayer = Replayer(client, replay_path, replay_speed)
+            gtk_replay(self.replayer)
+        else:
+            recorder = None
+            if record_path and use_workers:
+                print('Recording is not possible with worker processes')
+            elif record_path:
+                recorder = Recorder(record_path)
+                atexit.register(recorder.close)
+            # connect in the background, the window shows up meanwhile
+            for c in self.clients:
+                if use_workers:
+                    connection = GtkWorkerConnection(c)
+                else:
+                    connection = GtkConnection(c, recorder)
+                connection.connect(address, token)
+                self.connections.append(connection)
+                recorder = None  # a recording replays into only one client
+
+        self.world_viewer = wv = WorldViewer(client.world, max_fps, battery_fps)
         wv.draw_subscriber = wv.input_subscriber = self.multi_sub
+        wv.cell_index = cell_index
+        wv.interpolator = interpolator
         wv.focus_player(client.player)
 
     def on_world_update_post(self):
-        self.world_viewer.drawing_area.queue_draw()
+        self.world_viewer.invalidate()
 
     def on_key_pressed(self, val, char):
         if val == Gdk.KEY_Escape:
-            self.client.disconnect()
+            for connection in self.connections:
+                connection.close()
             Gtk.main_quit()
-        elif char == 'c':  # reconnect to any server
-            self.client.disconnect()
-            address, token = find_server()
-            self.client.connect(address, token)
-            self.world_viewer.focus_player(self.client.player)
+        elif char == 'c' and self.connections:
+            if self.merged:  # reconnect the focused client to the same server
+                connection = self.connections[self.merged.focus_index]
+                connection.connect(connection.address, connection.token)
+            else:  # reconnect to any server
+                self.connections[0].connect()
+        elif val == Gdk.KEY_Tab and self.merged:
+            self.merged.cycle_focus()
+            self.world_viewer.invalidate()
+        elif val == Gdk.KEY_F6 and self.profiler:
+            self.profiler.dump(self.profile_path)
+            print('Wrote handler timings to', self.profile_path)
+
+
+DEFAULT_PROFILE_PATH = 'gagar-profile.json'
+
+
+def pop_option(args, name):
+    """
+    Removes `--name` or `--name=value` from the list of arguments.
+    :return value, True if given without value, None if not given
+    """
+    for i, arg in enumerate(args):
+        if arg == '--' + name:
+            del args[i]
+            return True
+        if arg.startswith('--%s=' % name):
+            del args[i]
+            return arg.split('=', 1)[1]
+    return None
+
+
+def pop_positive_option(args, name, default):
+    """
+    Like pop_option(), for options that need a number greater than 0.
+    :return the number, `default` if not given, None if not a valid number
+    """
+    value = pop_option(args, name)
+    if value is None:
+        return default
+    if value is True:  # given without value
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        return None
+    return number if number > 0 else None
 
 
 def main():
@@ -278,23 +475,70 @@ def main():
           "Project homepage: https://github.com/Gjum/gagar\n"
           "Version: 0.1.4\n")
 
-    if len(sys.argv) > 1 and sys.argv[1] in ('-h', '--help'):
-        print("Usage: %s [nick]" % sys.argv[0])
-        print("       %s party <token> [nick]" % sys.argv[0])
-        print("       %s <IP:port> <token> [nick]" % sys.argv[0])
+    args = sys.argv[1:]
+    if args and args[0] in ('-h', '--help'):
+        print("Usage: %s [options] [nick]" % sys.argv[0])
+        print("       %s [options] party <token> [nick]" % sys.argv[0])
+        print("       %s [options] <IP:port> <token> [nick]" % sys.argv[0])
+        print("Options:")
+        print("  --profile[=FILE]  time all handlers, write timings to FILE"
+              " (default %s)" % DEFAULT_PROFILE_PATH)
+        print("  --record=FILE     record all server traffic to FILE")
+        print("  --replay=FILE     replay a recording instead of connecting")
+        print("  --fast            replay as fast as possible")
+        print("  --connections=N   connect N clients to the same server,"
+              " drawn as one world")
+        print("  --workers         run each connection in its own process"
+              " (Python 3.8+)")
+        print("  --log=FILE        append all log messages to FILE")
+        print("  --fps=N           draw at most N frames per second"
+              " (default 60)")
+        print("  --battery-fps=N   at most N frames per second on battery"
+              " (default 30)")
+        return
+
+    profile_path = pop_option(args, 'profile')
+    if profile_path is True:
+        profile_path = DEFAULT_PROFILE_PATH
+    record_path = pop_option(args, 'record')
+    replay_path = pop_option(args, 'replay')
+    replay_speed = 0 if pop_option(args, 'fast') else 1
+    num_connections = int(pop_option(args, 'connections') or 1)
+    use_workers = bool(pop_option(args, 'workers'))
+    log_path = pop_option(args, 'log')
+    max_fps = pop_positive_option(args, 'fps', 60)
+    battery_fps = pop_positive_option(args, 'battery-fps', 30)
+    if max_fps is None or battery_fps is None:
+        print('--fps and --battery-fps need a number greater than 0,'
+              ' e.g. --fps=30, see --help')
         return
 
-    address, token, nick, *_ = sys.argv[1:] + ([None] * 3)
+    address, token, nick, *_ = args + ([None] * 3)
+
+    if replay_path:
+        # address and token are not needed, only the nick
+        GtkControl(None, nick=address, max_fps=max_fps,
+                   battery_fps=battery_fps, profile_path=profile_path,
+                   replay_path=replay_path, replay_speed=replay_speed,
+                   log_path=log_path)
+        gtk_main_loop()
+        return
 
     if token is None:
         nick = address
         address = None
 
     if address and address[0] in 'Pp':
-        address = get_party_address(token)
+        address = PARTY  # looked up in the background, like any server
 
-    if not address:
-        address, token = find_server()
+    if num_connections > 1 and not address:
+        # servers found separately would be different worlds
+        print('--connections needs a party token or a server address')
+        return
 
-    GtkControl(address, token, nick)
+    # without address, GtkControl finds a server in the background
+    GtkControl(address, token, nick, max_fps=max_fps,
+               battery_fps=battery_fps, profile_path=profile_path,
+               record_path=record_path, num_connections=num_connections,
+               use_workers=use_workers, log_path=log_path)
     gtk_main_loop()
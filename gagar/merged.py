@@ -0,0 +1,200 @@
+"""
+Several connections in one process, drawn as one world.
+
+Each client's cell events go to a MergedWorldFeeder, which passes them on
+to a MergedWorld. A cell seen by several clients is kept and drawn once,
+and only removed when no client sees it anymore.
+The merged cell events are sent to MergedWorld.subscriber,
+where the CellIndex and Interpolator of the drawn world subscribe.
+
+Everything else (HUD, camera, controls) follows one focused client at a time:
+only the focused client's events are passed on to the drawing subscribers,
+and MergedWorld.focus stands in for the focused client.
+"""
+from agarnet.client import Client
+from agarnet.vec import Vec
+from agarnet.world import World
+from .subscriber import MultiSubscriber, Subscriber
+
+
+class FocusedClient(object):
+    """Stands in for the focused client, its player is in the merged world."""
+
+    def __init__(self, merged, client):
+        self.merged = merged
+        self.client = client
+
+    @property
+    def player(self):
+        return self.merged.player
+
+    @property
+    def world(self):
+        return self.merged.world
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class MergedPlayer(object):
+    """Stands in for the focused client's player, with cells of the merged world."""
+
+    def __init__(self, merged):
+        self.merged = merged
+
+    @property
+    def world(self):
+        return self.merged.world
+
+    @property
+    def own_cells(self):
+        cells = self.merged.world.cells
+        return (cells[cid] for cid in self.merged.focus.client.player.own_ids
+                if cid in cells)
+
+    def __getattr__(self, name):
+        return getattr(self.merged.focus.client.player, name)
+
+
+class FocusGate(MultiSubscriber):
+    """Passes the events of one client on, only while that client is focused."""
+
+    def __init__(self, merged, index, *subs):
+        super(FocusGate, self).__init__(*subs)
+        self.merged = merged
+        self.index = index
+
+    def handlers(self, func_name):
+        if self.merged.focus_index != self.index:
+            return []
+        return super(FocusGate, self).handlers(func_name)
+
+
+class MergedWorldFeeder(Subscriber):
+    """Passes the cell events of one client on to the MergedWorld."""
+
+    def __init__(self, merged, index):
+        self.merged = merged
+        self.index = index
+
+    def on_cell_info(self, cid, **info):
+        self.merged.update_cell(self.index, cid, info)
+
+    def on_cell_removed(self, cid):
+        self.merged.release_cell(self.index, cid)
+
+    def on_cell_eaten(self, eater_id, eaten_id):
+        self.merged.eat_cell(eater_id, eaten_id)
+
+    def on_clear_cells(self):
+        self.merged.release_all(self.index)
+
+    # the client's world gets reset when connecting
+    on_sock_open = on_clear_cells
+
+    def on_world_update_post(self):
+        self.merged.updated()
+
+    def on_world_rect(self, left, top, right, bottom):
+        world = self.merged.world
+        world.top_left = Vec(left, top)
+        world.bottom_right = Vec(right, bottom)
+
+    def on_leaderboard_names(self, leaderboard):
+        if self.merged.focus_index == self.index:
+            self.merged.world.leaderboard_names = leaderboard
+
+
+class MergedWorld(object):
+    """
+    Creates `num_clients` clients and merges their worlds into `world`.
+    The focused client's events go to `subscriber` unchanged.
+    """
+
+    def __init__(self, num_clients, subscriber, schedule_post=None):
+        """
+        :param subscriber: gets all events of the focused client
+        :param schedule_post: gets called with a function to call soon,
+            so updates of several clients result in one merged
+            on_world_update_post; None for calling it after each client update
+        """
+        self.world = World()
+        self.subscriber = MultiSubscriber()  # gets the merged cell events
+        self.schedule_post = schedule_post
+        self.post_scheduled = False
+        self.owners = {}  # cid -> set of client indices seeing that cell
+        self.infos = {}  # cid -> cell info as last applied to the world
+
+        self.clients = []
+        self.gates = []
+        for index in range(num_clients):
+            gate = FocusGate(self, index, subscriber)
+            self.gates.append(gate)
+            client_sub = MultiSubscriber(MergedWorldFeeder(self, index), gate)
+            self.clients.append(Client(client_sub))
+
+        self.focus_index = 0
+        self.focus = FocusedClient(self, self.clients[0])
+        self.player = MergedPlayer(self)
+
+    def set_focus(self, index):
+        self.focus_index = index % len(self.clients)
+        self.focus.client = self.clients[self.focus_index]
+        self.world.leaderboard_names = self.focus.client.world.leaderboard_names
+        for gate in self.gates:
+            gate.invalidate()
+
+    def cycle_focus(self):
+        self.set_focus(self.focus_index + 1)
+
+    def update_cell(self, index, cid, info):
+        owners = self.owners.get(cid)
+        if owners is None:
+            owners = self.owners[cid] = set()
+        elif self.infos.get(cid) == info:
+            # already updated by another client, or did not change
+            owners.add(index)
+            return
+        owners.add(index)
+        self.infos[cid] = info
+        self.subscriber.on_cell_info(cid=cid, **info)
+        if cid not in self.world.cells:
+            self.world.create_cell(cid)
+        cell = self.world.cells[cid]
+        cell.update(cid=cid, **info)
+        if info['name']:  # Cell.update() keeps the first name
+            cell.name = info['name']
+
+    def release_cell(self, index, cid):
+        owners = self.owners.get(cid)
+        if owners is None:
+            return
+        owners.discard(index)
+        if not owners:
+            del self.owners[cid]
+            del self.infos[cid]
+            del self.world.cells[cid]
+            self.subscriber.on_cell_removed(cid=cid)
+
+    def eat_cell(self, eater_id, eaten_id):
+        if self.owners.pop(eaten_id, None) is None:
+            return  # eaten already, seen by another client
+        del self.infos[eaten_id]
+        self.subscriber.on_cell_eaten(eater_id=eater_id, eaten_id=eaten_id)
+        del self.world.cells[eaten_id]
+
+    def release_all(self, index):
+        for cid in [cid for cid, owners in self.owners.items() if index in owners]:
+            self.release_cell(index, cid)
+
+    def updated(self):
+        if not self.schedule_post:
+            self.fire_post()
+        elif not self.post_scheduled:
+            self.post_scheduled = True
+            self.schedule_post(self.fire_post)
+
+    def fire_post(self):
+        self.post_scheduled = False
+        self.subscriber.on_world_update_post()
+        return False  # when called by a main loop, do not call again
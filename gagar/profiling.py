@@ -0,0 +1,101 @@
+"""
+Opt-in timing of subscriber handlers.
+
+Give a MultiSubscriber a Profiler via set_profiler(),
+and every handler it dispatches to gets timed into a Histogram
+per (subscriber class, event). Without a profiler, dispatching is unchanged.
+"""
+import json
+from time import perf_counter
+
+
+class Histogram(object):
+    """
+    Durations in power-of-two buckets from 1µs to about 8s,
+    so recording is cheap and memory does not grow.
+    """
+
+    NUM_BUCKETS = 24
+
+    def __init__(self):
+        self.buckets = [0] * self.NUM_BUCKETS
+        self.count = 0
+        self.total = 0.
+        self.max = 0.
+
+    def add(self, seconds):
+        bucket = min(int(seconds * 1e6).bit_length(), self.NUM_BUCKETS - 1)
+        self.buckets[bucket] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.
+
+    def percentile(self, q):
+        """Approximate duration in seconds below which a `q` fraction of calls took."""
+        if not self.count:
+            return 0.
+        rank = q * self.count
+        seen = 0
+        for bucket, num in enumerate(self.buckets):
+            seen += num
+            if seen >= rank:
+                # bucket holds [2**(bucket-1), 2**bucket) µs, take the middle
+                return min(self.max, 2 ** (bucket - .5) / 1e6)
+        return self.max
+
+
+class Profiler(object):
+    """Histograms of handler durations, by (subscriber class name, event)."""
+
+    def __init__(self):
+        self.histograms = {}
+
+    def clear(self):
+        self.histograms.clear()
+
+    def wrap(self, handler, func_name):
+        """Wraps the handler so its calls get timed."""
+        owner = getattr(handler, '__self__', None)
+        name = type(owner).__name__ if owner is not None \
+            else getattr(handler, '__qualname__', repr(handler))
+        key = name, func_name
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+
+        def timed(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return handler(*args, **kwargs)
+            finally:
+                histogram.add(perf_counter() - start)
+
+        return timed
+
+    def rows(self):
+        """(subscriber, event, histogram), most total time first."""
+        return sorted(((sub, event, hist) for (sub, event), hist
+                       in self.histograms.items() if hist.count),
+                      key=lambda row: -row[2].total)
+
+    def dump(self, path):
+        """Writes the statistics of all handlers as JSON."""
+        stats = [{
+            'subscriber': sub,
+            'event': event,
+            'calls': hist.count,
+            'total_ms': 1000 * hist.total,
+            'mean_ms': 1000 * hist.mean,
+            'p50_ms': 1000 * hist.percentile(.5),
+            'p99_ms': 1000 * hist.percentile(.99),
+            'max_ms': 1000 * hist.max,
+            'buckets': hist.buckets,
+        } for sub, event, hist in self.rows()]
+        with open(path, 'w') as f:
+            json.dump(stats, f, indent=2)
+            f.write('\n')
@@ -84,6 +84,8 @@ class Reloadable(object):
         Reloads the containing module and replaces all instance attributes
         (monkey-patching, see https://filippo.io/instance-monkey-patching-in-python/ )
         while keeping the attributes in _persistent_attributes.
+        MultiSubscribers cache the handlers of their subscribers,
+        call invalidate() on the containing one after reloading.
         """
         if not new_module:
             new_module = importlib.reload(sys.modules[self.__module__])
@@ -0,0 +1,142 @@
+"""
+Recording of raw server traffic, and replaying it without network.
+
+A recording starts with MAGIC, followed by one record per received
+websocket frame: little endian float64 seconds since the recording started
+(monotonic clock), uint32 frame length, and the frame itself.
+"""
+import struct
+from time import monotonic
+
+MAGIC = b'GAGARREC1\n'
+RECORD_HEADER = struct.Struct('<dI')
+
+
+class Recorder(object):
+    """Appends frames to a recording file, timestamped from its creation."""
+
+    def __init__(self, path, flush_interval=1.):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.start_time = self.last_flush = monotonic()
+
+    def write(self, frame):
+        if isinstance(frame, str):
+            frame = frame.encode('utf-8')
+        now = monotonic()
+        self.file.write(RECORD_HEADER.pack(now - self.start_time, len(frame)))
+        self.file.write(frame)
+        if now - self.last_flush > self.flush_interval:
+            self.file.flush()
+            self.last_flush = now
+
+    def close(self):
+        self.file.close()
+
+
+class RecordingSocket(object):
+    """Wraps a websocket, recording every frame received through it."""
+
+    def __init__(self, ws, recorder):
+        self._ws = ws
+        self.recorder = recorder
+
+    def recv(self):
+        frame = self._ws.recv()
+        if frame:
+            self.recorder.write(frame)
+        return frame
+
+    def __getattr__(self, name):
+        return getattr(self._ws, name)
+
+
+def read_recording(path):
+    """Yields (seconds since recording start, frame) of a recording."""
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('Not a gagar recording: %s' % path)
+        while True:
+            header = f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return  # end of file, or cut off while recording
+            timestamp, length = RECORD_HEADER.unpack(header)
+            frame = f.read(length)
+            if len(frame) < length:
+                return
+            yield timestamp, frame
+
+
+class ReplaySocket(object):
+    """
+    Stands in for the websocket of a Client, returning recorded frames.
+    Anything sent is dropped, there is no server to talk to.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.connected = True
+        self._records = read_recording(path)
+        self.next_record = next(self._records, None)  # (timestamp, frame)
+
+    def recv(self):
+        if not self.next_record:
+            raise EOFError('End of recording %s' % self.path)
+        frame = self.next_record[1]
+        self.next_record = next(self._records, None)
+        return frame
+
+    def connect(self, *args, **kwargs):
+        self.connected = True
+
+    def close(self, *args, **kwargs):
+        self.connected = False
+
+    def settimeout(self, timeout):
+        pass
+
+    def send(self, *args, **kwargs):
+        pass
+
+
+class Replayer(object):
+    """
+    Feeds a recording into a Client through a ReplaySocket,
+    either in real time or as fast as possible.
+    The caller decides when to call feed(), e.g. from a main loop.
+    """
+
+    def __init__(self, client, path, speed=1.):
+        """
+        :param speed: 1 for real time, 0 for as fast as possible
+        """
+        self.client = client
+        self.speed = speed
+        self.socket = client.ws = ReplaySocket(path)
+        client.address = 'replay of %s' % path
+        self.start_time = None
+
+    @property
+    def finished(self):
+        return self.socket.next_record is None
+
+    def feed(self, max_frames=100):
+        """
+        Passes the frames that are due to the client, at most `max_frames`.
+        :return seconds until the next frame is due, None when finished
+        """
+        now = monotonic()
+        if self.start_time is None:
+            self.start_time = now
+        elapsed = (now - self.start_time) * self.speed
+        for _ in range(max_frames):
+            record = self.socket.next_record
+            if record is None:
+                return None
+            timestamp, frame = record
+            if self.speed and timestamp > elapsed:
+                return (timestamp - elapsed) / self.speed
+            self.client.on_message()
+        return 0
@@ -1,6 +1,11 @@
+from collections import OrderedDict
+import http.client
 import io
-from threading import Thread
-import urllib.request
+import os
+import queue
+from threading import Lock, Thread
+from time import time
+import urllib.parse
 
 import cairo
 
@@ -9,49 +14,295 @@ from .drawutils import TWOPI
 from .subscriber import Subscriber
 
 
-skin_cache = {}  # raw PNG data
-skin_surface_cache = {}  # images in cairo format
+SKIN_URL = 'http://agar.io/skins/'
+
+
+def default_cache_dir():
+    cache_home = os.environ.get('XDG_CACHE_HOME') \
+        or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_home, 'gagar', 'skins')
+
+
+class SkinNotFound(Exception):
+    """The server has no skin with that name, do not ask again."""
+
+
+class SkinLoader(object):
+    """
+    Loads raw skin PNG data in a fixed number of daemon worker threads.
+    Each worker keeps its HTTP connection open between downloads.
+    Downloaded skins are kept in a directory that survives restarts,
+    failed downloads are retried with exponential backoff.
+    Keeps at most `max_bytes` of PNG data in memory,
+    least recently used skins are evicted and get read from disk again.
+    """
+
+    def __init__(self, base_url=SKIN_URL, cache_dir=None, workers=2,
+                 max_bytes=16 * 1024 * 1024, retries=4, retry_delay=2.0,
+                 timeout=10):
+        """
+        :param base_url: skins are loaded from base_url + name + '.png'
+        :param cache_dir: where to keep downloaded skins,
+                          None for the default, False for no disk cache
+        """
+        url = urllib.parse.urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection \
+            if url.scheme == 'https' else http.client.HTTPConnection
+        self.host = url.netloc
+        self.path = url.path if url.path.endswith('/') else url.path + '/'
+        self.headers = dict(default_headers)
+        self.cache_dir = default_cache_dir() if cache_dir is None else cache_dir
+        self.num_workers = workers
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.timeout = timeout
+
+        self._lock = Lock()  # guards everything below
+        self._data = OrderedDict()  # name -> PNG data, least recently used first
+        self._num_bytes = 0
+        self._pending = set()  # queued or being loaded
+        self._failed = {}  # name -> (attempts, retry at); retry at None: never
+        self._queue = queue.Queue()
+        self._workers = []  # started on first request
+
+    def get(self, name):
+        """
+        Raw PNG data of the skin.
+        Returns None while it is being loaded, or if loading failed.
+        """
+        name = name.lower()
+        with self._lock:
+            data = self._data.get(name)
+            if data is not None:
+                self._data.move_to_end(name)
+                return data
+            if name in self._pending:
+                return None
+            if name in self._failed:
+                attempts, retry_at = self._failed[name]
+                if retry_at is None or time() < retry_at:
+                    return None
+            self._pending.add(name)
+            if not self._workers:
+                self._start_workers()
+        self._queue.put(name)
+        return None
+
+    def mark_broken(self, name):
+        """The data of this skin is unusable, forget it and do not load it again."""
+        name = name.lower()
+        with self._lock:
+            data = self._data.pop(name, None)
+            if data is not None:
+                self._num_bytes -= len(data)
+            self._failed[name] = (None, None)
+        path = self._cache_path(name)
+        if path and os.path.isfile(path):
+            os.remove(path)
+
+    def _start_workers(self):
+        for _ in range(self.num_workers):
+            worker = Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def _work(self):
+        connection = None
+        while True:
+            name = self._queue.get()
+            try:
+                data = self._read_cached(name)
+                if data is None:
+                    if connection is None:
+                        connection = self.connection_class(
+                            self.host, timeout=self.timeout)
+                    data = self._download(connection, name)
+                    try:
+                        self._write_cached(name, data)
+                    except OSError:
+                        pass  # e.g. read-only cache dir, still show the skin
+            except SkinNotFound:
+                self._loaded(name, None, give_up=True)
+            except (OSError, http.client.HTTPException):
+                if connection:
+                    connection.close()
+                connection = None  # reconnect for the next skin
+                self._loaded(name, None)
+            else:
+                self._loaded(name, data)
+
+    def _download(self, connection, name):
+        url = self.path + urllib.parse.quote(name) + '.png'
+        connection.request('GET', url, headers=self.headers)
+        response = connection.getresponse()
+        data = response.read()  # always read, to reuse the connection
+        if response.status == 404:
+            raise SkinNotFound(name)
+        if response.status != 200:
+            raise OSError('Got HTTP %i for skin "%s"' % (response.status, name))
+        return data
+
+    def _loaded(self, name, data, give_up=False):
+        with self._lock:
+            self._pending.discard(name)
+            if data is None:
+                attempts = self._failed.get(name, (0, None))[0] or 0
+                attempts += 1
+                if give_up or attempts > self.retries:
+                    self._failed[name] = (None, None)
+                else:
+                    retry_at = time() + self.retry_delay * 2 ** (attempts - 1)
+                    self._failed[name] = (attempts, retry_at)
+                return
+            self._failed.pop(name, None)
+            self._data[name] = data
+            self._num_bytes += len(data)
+            while self._num_bytes > self.max_bytes and len(self._data) > 1:
+                _, evicted = self._data.popitem(last=False)
+                self._num_bytes -= len(evicted)
+
+    def _cache_path(self, name):
+        if not self.cache_dir:
+            return None
+        return os.path.join(self.cache_dir,
+                            urllib.parse.quote(name, safe='') + '.png')
+
+    def _read_cached(self, name):
+        path = self._cache_path(name)
+        if not path or not os.path.isfile(path):
+            return None
+        try:
+            with open(path, 'rb') as f:
+                return f.read()
+        except OSError:  # download it again
+            return None
+
+    def _write_cached(self, name, data):
+        path = self._cache_path(name)
+        if not path:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_path = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)  # never leave half written skins
+
+
+skin_loader = SkinLoader()
 
 
 def get_skin(name):
-    name = name.lower()
-    if name not in skin_cache:
-        # load in separate thread, return None for now
-        skin_cache[name] = None
+    return skin_loader.get(name)
+
+
+class SkinMipmaps(object):
+    """
+    Decoded skins, clipped to a circle and pre-scaled to power-of-two sizes,
+    so small cells do not get filtered from the full-size image every frame.
+    Keeps at most `max_bytes` of surfaces, least recently used skins are evicted.
+    """
 
-        def loader():
-            skin_url = 'http://agar.io/skins/%s.png' % urllib.request.quote(
-                name)
-            opener = urllib.request.build_opener()
-            opener.addheaders = default_headers
-            skin_cache[name] = opener.open(skin_url).read()
+    def __init__(self, max_bytes=32 * 1024 * 1024, min_size=16):
+        self.max_bytes = max_bytes
+        self.min_size = min_size
+        self._levels = OrderedDict()  # name -> surfaces, largest first
+        self._num_bytes = 0
 
-        t = Thread(target=loader)
-        t.setDaemon(True)
-        t.start()
-    return skin_cache[name]
+    def __contains__(self, name):
+        return name in self._levels
+
+    def add(self, name, surface):
+        levels = self._make_levels(surface)
+        self.remove(name)
+        self._levels[name] = levels
+        self._num_bytes += sum(s.get_stride() * s.get_height() for s in levels)
+        while self._num_bytes > self.max_bytes and len(self._levels) > 1:
+            self.remove(next(iter(self._levels)))
+
+    def remove(self, name):
+        levels = self._levels.pop(name, None)
+        if levels:
+            self._num_bytes -= sum(s.get_stride() * s.get_height() for s in levels)
+
+    def get(self, name, diameter):
+        """
+        The smallest version of the skin that is at least `diameter` wide,
+        or the largest one if there is none.
+        """
+        levels = self._levels.get(name)
+        if not levels:
+            return None
+        self._levels.move_to_end(name)
+        for surface in reversed(levels):
+            if surface.get_width() >= diameter:
+                return surface
+        return levels[0]
+
+    def _make_levels(self, surface):
+        size = surface.get_width()
+        # clip once, the circle is transparent around it in all levels
+        clipped = cairo.ImageSurface(cairo.FORMAT_ARGB32, size, size)
+        c = cairo.Context(clipped)
+        c.arc(size / 2, size / 2, size / 2, 0, TWOPI)
+        c.clip()
+        c.set_source_surface(surface, 0, 0)
+        c.paint()
+        levels = [clipped]
+
+        level_size = 1
+        while level_size * 2 < size:
+            level_size *= 2
+        while level_size >= self.min_size:
+            previous = levels[-1]
+            scaled = cairo.ImageSurface(cairo.FORMAT_ARGB32, level_size, level_size)
+            c = cairo.Context(scaled)
+            scale = level_size / previous.get_width()
+            c.scale(scale, scale)
+            c.set_source_surface(previous, 0, 0)
+            c.get_source().set_filter(cairo.FILTER_GOOD)
+            c.paint()
+            levels.append(scaled)
+            level_size //= 2
+        return levels
 
 
 class CellSkins(Subscriber):
+    def __init__(self, loader=None, mipmaps=None):
+        self.loader = loader or skin_loader
+        self.mipmaps = mipmaps or SkinMipmaps()
+
+    def get_surface(self, name, diameter):
+        if name not in self.mipmaps:
+            skin_data = self.loader.get(name)
+            if not skin_data:  # image is still being loaded
+                return None
+            try:
+                surface = cairo.ImageSurface.create_from_png(io.BytesIO(skin_data))
+            except (MemoryError, cairo.Error):  # not a valid PNG
+                self.loader.mark_broken(name)
+                return None
+            self.mipmaps.add(name, surface)
+        return self.mipmaps.get(name, diameter)
+
     def on_draw_cells(self, c, w):
         c = c._cairo_context
-        for cell in w.world.cells.values():
+        f = w.frame
+        for cell, x, y, radius in zip(f.cells, f.x.tolist(), f.y.tolist(),
+                                      f.radius.tolist()):
             name = cell.name.lower()
             if name in special_names:
-                skin_data = get_skin(name)
-                if not skin_data:  # image is still being loaded
+                skin_surface = self.get_surface(name, 2 * radius)
+                if not skin_surface:
                     continue  # TODO fancy loading circle animation
-                if name not in skin_surface_cache:
-                    skin_surface_cache[name] = cairo.ImageSurface.create_from_png(io.BytesIO(skin_data))
-                skin_surface = skin_surface_cache[name]
-                skin_radius = skin_surface.get_width() / 2
+                skin_size = skin_surface.get_width()
                 c.save()
-                c.translate(*w.world_to_screen_pos(cell.pos))
-                scale = w.world_to_screen_size(cell.size / skin_radius)
+                c.translate(x - radius, y - radius)
+                scale = 2 * radius / skin_size
                 c.scale(scale, scale)
-                c.translate(-skin_radius, -skin_radius)
+                # already clipped to a circle
                 c.set_source_surface(skin_surface, 0, 0)
-                c.new_sub_path()
-                c.arc(skin_radius, skin_radius, skin_radius, 0, TWOPI)
+                c.rectangle(0, 0, skin_size, skin_size)
                 c.fill()
                 c.restore()
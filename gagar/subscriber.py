@@ -1,3 +1,7 @@
+def _noop(*args, **kwargs):
+    """Default handler, does nothing."""
+
+
 class Subscriber(object):
     """Base class for event handlers via on_*() methods."""
 
@@ -6,26 +10,129 @@ class Subscriber(object):
         if 'on_' != func_name[:3]:
             raise AttributeError("'%s' object has no attribute '%s'"
                                  % (self.__class__.__name__, func_name))
-        return lambda *args, **kwargs: None  # default handler does nothing
+        return _noop  # default handler does nothing
 
 
 class MultiSubscriber(Subscriber):
-    """Distributes method calls to multiple subscribers."""
+    """
+    Distributes method calls to multiple subscribers.
+
+    The handlers for each event are looked up once and cached
+    as a flat list, including those of nested MultiSubscribers.
+    The cache is rebuilt after sub() and after invalidate(),
+    which needs to be called when a nested subscriber changes its handlers.
+
+    With a Profiler set via set_profiler(), every handler call gets timed.
+    """
 
     def __init__(self, *subs):
-        self.subs = list(subs)
+        self.subs = []
+        self.profiler = None
+        self._parents = []  # MultiSubscribers that contain this one
+        self._dispatchers = {}  # func_name -> cached dispatcher
+        for sub in subs:
+            self.sub(sub)
 
     def sub(self, subscriber):
         self.subs.append(subscriber)
+        if isinstance(subscriber, MultiSubscriber):
+            subscriber._parents.append(self)
+        self.invalidate()
         return subscriber
 
+    def set_profiler(self, profiler):
+        """Time all handler calls dispatched by this subscriber, None to stop."""
+        self.profiler = profiler
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget the cached handlers, here and in all containing subscribers."""
+        for func_name in self._dispatchers:
+            self.__dict__.pop(func_name, None)
+        self._dispatchers.clear()
+        for parent in self._parents:
+            parent.invalidate()
+
+    def handlers(self, func_name):
+        """Flat list of all handlers to call for this event, in order."""
+        handlers = []
+        for sub in self.subs:
+            if isinstance(sub, MultiSubscriber) \
+                    and getattr(type(sub), func_name, None) is None:
+                handlers.extend(sub.handlers(func_name))
+            else:
+                handler = getattr(sub, func_name, None)
+                if handler and handler is not _noop:
+                    handlers.append(handler)
+        return handlers
+
     def __getattr__(self, func_name):
         super(MultiSubscriber, self).__getattr__(func_name)
 
-        def wrapper(*args, **kwargs):
-            for sub in self.subs:
-                handler = getattr(sub, func_name, None)
-                if handler:
+        handlers = self.handlers(func_name)
+        if self.profiler:
+            handlers = [self.profiler.wrap(handler, func_name)
+                        for handler in handlers]
+        if not handlers:
+            dispatcher = _noop
+        elif len(handlers) == 1:
+            dispatcher = handlers[0]
+        else:
+            def dispatcher(*args, **kwargs):
+                for handler in handlers:
                     handler(*args, **kwargs)
 
-        return wrapper
+        # cache as instance attribute, so __getattr__ is not called again
+        self._dispatchers[func_name] = dispatcher
+        setattr(self, func_name, dispatcher)
+        return dispatcher
+
+
+class Coalescer(Subscriber):
+    """
+    Passes all events on to a subscriber, except the `coalesced` ones,
+    which are held back until flush() and then called once each.
+    Meant to be put in place of a client's subscriber while it
+    processes a batch of messages.
+    """
+
+    def __init__(self, subscriber, coalesced=('on_world_update_post',)):
+        self.subscriber = subscriber
+        self.pending = []  # func_names called since the last flush()
+        for func_name in coalesced:
+            setattr(self, func_name, self._holder(func_name))
+
+    def _holder(self, func_name):
+        def hold():
+            if func_name not in self.pending:
+                self.pending.append(func_name)
+        return hold
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        for func_name in pending:
+            getattr(self.subscriber, func_name)()
+
+    def __getattr__(self, func_name):
+        return getattr(self.subscriber, func_name)
+
+
+class KeyToggler(MultiSubscriber):
+    """Passes events on to its subscribers only while enabled, toggled by a key."""
+
+    def __init__(self, key, *subs, disabled=False):
+        super(KeyToggler, self).__init__(*subs)
+        self.toggle_key = key
+        self.enabled = not disabled
+
+    def handlers(self, func_name):
+        if not self.enabled:
+            return []
+        return super(KeyToggler, self).handlers(func_name)
+
+    def on_key_pressed(self, val, char):
+        if val == self.toggle_key:
+            self.enabled = not self.enabled
+            self.invalidate()
+        for handler in self.handlers('on_key_pressed'):
+            handler(val, char)
@@ -0,0 +1,145 @@
+"""
+How dangerous each cell is to the player, computed once per world update.
+
+The mass rules (eating needs 1.33 times the mass, splitting halves it)
+only live here. Overlays and bots look up the result by cell id
+instead of comparing masses themselves on every frame.
+"""
+from itertools import chain
+
+import numpy
+
+from .subscriber import Subscriber
+
+# threat classes, from the player's point of view
+NONE = 0  # own cell, food, ejected mass or virus
+SPLIT_PREY = 1  # can be eaten by splitting
+PREY = 2  # can be eaten
+SIMILAR = 3  # neither can eat the other
+PREDATOR = 4  # can eat the player's smallest cell
+SPLIT_PREDATOR = 5  # can split and eat the player's smallest cell
+
+EAT_RATIO = 1.33
+SPLIT_DIST = 760  # how far a split cell flies, roughly
+MIN_SPLIT_SIZE = 60  # smaller cells cannot split
+
+
+class ThreatAnalysis(Subscriber):
+    """
+    Classifies all cells of the player's world, vectorized.
+    Only computed when read after a world update, then cached.
+    Look up cells with lookup(), then index `threat`, `split_radius`
+    and `virus_danger` with the result.
+    """
+
+    def __init__(self, player):
+        self.player = player
+        self.dirty = True
+        self._cid = numpy.zeros(0, dtype=int)  # sorted
+        # one more entry than cells, for cells that were not analyzed
+        self._threat = numpy.zeros(1, dtype=numpy.int8)
+        self._split_radius = numpy.zeros(1)
+        self._virus_danger = numpy.zeros(1, dtype=bool)
+        self._own_max_size = 0
+
+    def on_world_update_post(self):
+        self.dirty = True
+
+    def on_own_id(self, cid):
+        self.dirty = True
+
+    on_clear_cells = on_world_update_post
+    on_sock_open = on_world_update_post
+
+    @property
+    def threat(self):
+        """Threat class of each cell (NONE, SPLIT_PREY, ...)."""
+        self.analyze()
+        return self._threat
+
+    @property
+    def split_radius(self):
+        """
+        World distance from which each cell can split and eat the player's
+        smallest cell, 0 if it cannot.
+        """
+        self.analyze()
+        return self._split_radius
+
+    @property
+    def virus_danger(self):
+        """True for each virus that would split the player's largest cell."""
+        self.analyze()
+        return self._virus_danger
+
+    @property
+    def own_max_size(self):
+        """Size of the player's largest cell, 0 if dead."""
+        self.analyze()
+        return self._own_max_size
+
+    def lookup(self, cids):
+        """
+        Positions of these cell ids in the result arrays.
+        Cells that were not analyzed get NONE, 0 and False.
+        """
+        self.analyze()
+        cids = numpy.asarray(cids, dtype=int)
+        num_cells = len(self._cid)
+        if not num_cells:
+            return numpy.zeros(len(cids), dtype=int)
+        index = numpy.searchsorted(self._cid, cids)
+        found = self._cid[numpy.minimum(index, num_cells - 1)] == cids
+        return numpy.where(found, index, num_cells)
+
+    def analyze(self):
+        if not self.dirty:
+            return
+        self.dirty = False
+
+        cells = self.player.world.cells.values()
+        values = numpy.fromiter(
+            chain.from_iterable((cell.cid, cell.size, cell.is_virus,
+                                 cell.is_food or cell.is_ejected_mass)
+                                for cell in cells),
+            dtype=float, count=len(cells) * 4).reshape(-1, 4)
+        values = values[numpy.argsort(values[:, 0], kind='stable')]
+
+        cid = values[:, 0].astype(int)
+        size = values[:, 1]
+        mass = size * size / 100
+        virus = values[:, 2] != 0
+        harmless = values[:, 3] != 0
+        own = numpy.isin(cid, list(self.player.own_ids))
+
+        if own.any():
+            own_max_size = float(size[own].max())
+            own_min_mass = mass[own].min()
+        else:  # spectating or dead, every large cell is dangerous
+            own_max_size = own_min_mass = 0
+        others = ~(own | harmless | virus)
+
+        threat = numpy.zeros(len(cid) + 1, dtype=numpy.int8)
+        if own.any():
+            # later rules take precedence
+            cls = numpy.full(len(cid), SIMILAR, dtype=numpy.int8)
+            cls[mass > own_min_mass * EAT_RATIO] = PREDATOR
+            cls[mass > own_min_mass * EAT_RATIO * 2] = SPLIT_PREDATOR
+            cls[own_min_mass > mass * EAT_RATIO] = PREY
+            cls[own_min_mass > mass * EAT_RATIO * 2] = SPLIT_PREY
+            threat[:-1][others] = cls[others]
+
+        split_radius = numpy.zeros(len(cid) + 1)
+        can_split_kill = others & (size >= MIN_SPLIT_SIZE) \
+            & (mass > own_min_mass * EAT_RATIO * 2)
+        split_radius[:-1][can_split_kill] = numpy.maximum(
+            SPLIT_DIST + size[can_split_kill] * .7071, size[can_split_kill])
+
+        virus_danger = numpy.zeros(len(cid) + 1, dtype=bool)
+        virus_danger[:-1] = virus & ~(own | harmless) & (size < own_max_size)
+
+        self._cid = cid
+        self._threat = threat
+        self._split_radius = split_radius
+        self._virus_danger = virus_danger
+        self._own_max_size = own_max_size
@@ -0,0 +1,130 @@
+from agarnet.vec import Vec
+from .drawutils import Canvas
+from .frame import FrameCells
+
+
+class WorldView(object):
+    """
+    Draws one world onto a cairo context, without needing a window.
+    Calls draw_subscriber.on_draw_{background|cells|hud}() methods when drawing.
+    """
+
+    INFO_SIZE = 300
+
+    def __init__(self, world):
+        self.world = world
+        self.player = None  # the focused player, or None to show full world
+
+        # the class instance on which to call draw_background, draw_cells, draw_hud
+        self.draw_subscriber = None
+
+        # optional CellIndex of the world, used to skip cells outside the window
+        self.cell_index = None
+        # optional Interpolator of the world, for smooth movement between updates
+        self.interpolator = None
+        # cells that can be seen in the current frame, in draw order
+        # (largest first), set before drawing
+        self.visible_cells = []
+        # the visible cells as arrays, in screen coordinates, set before drawing
+        self.frame = FrameCells()
+        # cells of the focused player in the current frame, set before drawing
+        self.own_cells = []
+
+        self.win_size = Vec(1000, 1000 * 9 / 16)
+        self.screen_center = self.win_size / 2
+        self.screen_scale = 1
+        self.world_center = Vec(0, 0)
+        self.mouse_pos = Vec(0, 0)
+
+    def focus_player(self, player):
+        """Follow this client regarding center and zoom."""
+        self.player = player
+        self.world = player.world
+
+    def show_full_world(self, world=None):
+        """
+        Show the full world view instead of one client.
+        :param world: optionally update the drawn world
+        """
+        self.player = None
+        if world:
+            self.world = world
+
+    def world_to_screen_pos(self, world_pos):
+        return (world_pos - self.world_center) \
+            .imul(self.screen_scale).iadd(self.screen_center)
+
+    def screen_to_world_pos(self, screen_pos):
+        return (screen_pos - self.screen_center) \
+            .idiv(self.screen_scale).iadd(self.world_center)
+
+    def world_to_screen_size(self, world_size):
+        return world_size * self.screen_scale
+
+    def cells_in_view(self, margin=0):
+        """
+        Cells in or near the window, in draw order (largest first).
+        Interpolated, if there is an interpolator for the world.
+        :param margin: also include cells this far (world size) outside
+        """
+        index = self.cell_index
+        if not index or index.world is not self.world:
+            cells = sorted(self.world.cells.values(), reverse=True)
+        else:
+            if self.interpolating:
+                margin += 50  # cells are drawn behind their actual position
+            left, top = self.screen_to_world_pos(Vec(0, 0))
+            right, bottom = self.screen_to_world_pos(self.win_size)
+            cells = index.cells_in_rect(left - margin, top - margin,
+                                        right + margin, bottom + margin)
+        if self.interpolating:
+            interpolated = self.interpolator.cell
+            return [interpolated(cell) for cell in cells]
+        return cells
+
+    @property
+    def interpolating(self):
+        return self.interpolator and self.interpolator.world is self.world
+
+    def recalculate(self):
+        self.screen_center = self.win_size / 2
+        if self.player:  # any client is focused
+            window_scale = max(self.win_size.x / 1920, self.win_size.y / 1080)
+            self.world = self.player.world
+            if self.interpolating and self.interpolator.player is self.player:
+                self.screen_scale = self.interpolator.frame_scale * window_scale
+                self.world_center = self.interpolator.frame_center
+            else:
+                self.screen_scale = self.player.scale * window_scale
+                self.world_center = self.player.center
+        elif self.world.size:
+            self.screen_scale = min(self.win_size.x / self.world.size.x,
+                                    self.win_size.y / self.world.size.y)
+            self.world_center = self.world.center
+        else:
+            # happens when the window gets drawn before the world got updated
+            self.screen_scale = 1
+            self.world_center = Vec(0, 0)
+
+    def prepare_frame(self):
+        """Update view and visible cells, called before drawing a frame."""
+        if self.interpolator:
+            self.interpolator.frame()
+        self.recalculate()
+        self.visible_cells = self.cells_in_view()
+        self.frame.update(self.visible_cells,
+                          self.player.own_ids if self.player else (),
+                          self.world_center, self.screen_scale,
+                          self.screen_center)
+        self.own_cells = list(self.player.own_cells) if self.player else []
+        if self.interpolating:
+            interpolated = self.interpolator.cell
+            self.own_cells = [interpolated(cell) for cell in self.own_cells]
+
+    def render(self, cairo_context):
+        c = Canvas(cairo_context)
+        if self.draw_subscriber:
+            self.prepare_frame()
+            self.draw_subscriber.on_draw_background(c, self)
+            self.draw_subscriber.on_draw_cells(c, self)
+            self.draw_subscriber.on_draw_hud(c, self)
@@ -1,35 +1,59 @@
+import glob
+import os
+
 import gi
 gi.require_version('Gtk', '3.0')
-from gi.repository import Gtk, Gdk
+from gi.repository import Gtk, Gdk, GLib
 
 from agarnet.vec import Vec
-from .drawutils import Canvas
+from .view import WorldView
 
 
-class WorldViewer(object):
+def on_battery_power():
+    """True if there is a battery and no power supply is plugged in (Linux only)."""
+    has_battery = False
+    for supply in glob.glob('/sys/class/power_supply/*'):
+        try:
+            with open(os.path.join(supply, 'type')) as f:
+                supply_type = f.read().strip()
+            if supply_type == 'Battery':
+                has_battery = True
+            elif supply_type == 'Mains':
+                with open(os.path.join(supply, 'online')) as f:
+                    if f.read().strip() == '1':
+                        return False
+        except OSError:
+            continue
+    return has_battery
+
+
+class WorldViewer(WorldView):
     """
-    Draws one world and handles keys/mouse.
+    Draws one world in a GTK window and handles keys/mouse.
     Does not poll for events itself.
     Calls input_subscriber.on_{key_pressed|mouse_moved}() methods on key/mouse input.
     Calls draw_subscriber.on_draw_{background|cells|hud}() methods when drawing.
-    """
 
-    INFO_SIZE = 300
+    Redraws are driven by the GTK frame clock: invalidate() only marks
+    the view as dirty, and it gets drawn at most once per frame,
+    limited to max_fps (battery_fps when running on battery).
+    """
 
-    def __init__(self, world):
-        self.world = world
-        self.player = None  # the focused player, or None to show full world
+    def __init__(self, world, max_fps=60, battery_fps=30):
+        """
+        :param max_fps: highest frame rate, None for drawing on every frame
+        :param battery_fps: highest frame rate on battery power, None for max_fps
+        """
+        super(WorldViewer, self).__init__(world)
 
         # the class instance on which to call on_key_pressed and on_mouse_moved
         self.input_subscriber = None
-        # same for draw_background, draw_cells, draw_hud
-        self.draw_subscriber = None
 
-        self.win_size = Vec(1000, 1000 * 9 / 16)
-        self.screen_center = self.win_size / 2
-        self.screen_scale = 1
-        self.world_center = Vec(0, 0)
-        self.mouse_pos = Vec(0, 0)
+        self.max_fps = max_fps
+        self.battery_fps = battery_fps
+        self.on_battery = on_battery_power()
+        self.dirty = True  # needs to be redrawn
+        self.next_frame_time = 0  # frame clock time in µs
 
         window = Gtk.Window()
         window.set_title('agar.io')
@@ -45,22 +69,40 @@ class WorldViewer(object):
         window.connect('button-press-event', self.mouse_pressed)
 
         self.drawing_area.connect('draw', self.draw)
+        self.drawing_area.add_tick_callback(self.tick)
+        GLib.timeout_add_seconds(10, self.check_battery)
 
         window.show_all()
 
-    def focus_player(self, player):
-        """Follow this client regarding center and zoom."""
-        self.player = player
-        self.world = player.world
-
-    def show_full_world(self, world=None):
-        """
-        Show the full world view instead of one client.
-        :param world: optionally update the drawn world
-        """
-        self.player = None
-        if world:
-            self.world = world
+    @property
+    def target_fps(self):
+        if self.on_battery and self.battery_fps:
+            return min(self.battery_fps, self.max_fps or self.battery_fps)
+        return self.max_fps
+
+    def invalidate(self):
+        """Request a redraw. Any number of requests get merged into one frame."""
+        self.dirty = True
+
+    def tick(self, widget, frame_clock):
+        """Called by GTK once per frame, draws if dirty and not over target_fps."""
+        if self.interpolator and self.interpolator.is_animating():
+            self.dirty = True
+        if self.dirty:
+            now = frame_clock.get_frame_time()
+            target_fps = self.target_fps
+            # allow drawing a bit early, frames do not arrive exactly in time
+            if not target_fps or now + 2000 >= self.next_frame_time:
+                self.dirty = False
+                self.drawing_area.queue_draw()
+                if target_fps:
+                    self.next_frame_time = max(
+                        self.next_frame_time + 1000000 / target_fps, now)
+        return GLib.SOURCE_CONTINUE
+
+    def check_battery(self):
+        self.on_battery = on_battery_power()
+        return GLib.SOURCE_CONTINUE
 
     def key_pressed(self, _, event):
         """Called by GTK. Set input_subscriber to handle this."""
@@ -71,11 +113,13 @@ class WorldViewer(object):
         except ValueError:
             char = ''
         self.input_subscriber.on_key_pressed(val=val, char=char)
+        self.invalidate()  # overlays may have been toggled
 
     def mouse_moved(self, _, event):
         """Called by GTK. Set input_subscriber to handle this."""
         if not self.input_subscriber: return
         self.mouse_pos = Vec(event.x, event.y)
+        self.invalidate()
         pos_world = self.screen_to_world_pos(self.mouse_pos)
         self.input_subscriber.on_mouse_moved(pos=self.mouse_pos, pos_world=pos_world)
 
@@ -84,39 +128,11 @@ class WorldViewer(object):
         if not self.input_subscriber: return
         self.input_subscriber.on_mouse_pressed(button=event.button)
 
-    def world_to_screen_pos(self, world_pos):
-        return (world_pos - self.world_center) \
-            .imul(self.screen_scale).iadd(self.screen_center)
-
-    def screen_to_world_pos(self, screen_pos):
-        return (screen_pos - self.screen_center) \
-            .idiv(self.screen_scale).iadd(self.world_center)
-
-    def world_to_screen_size(self, world_size):
-        return world_size * self.screen_scale
-
     def recalculate(self):
         alloc = self.drawing_area.get_allocation()
         self.win_size.set(alloc.width, alloc.height)
-        self.screen_center = self.win_size / 2
-        if self.player:  # any client is focused
-            window_scale = max(self.win_size.x / 1920, self.win_size.y / 1080)
-            self.screen_scale = self.player.scale * window_scale
-            self.world_center = self.player.center
-            self.world = self.player.world
-        elif self.world.size:
-            self.screen_scale = min(self.win_size.x / self.world.size.x,
-                                    self.win_size.y / self.world.size.y)
-            self.world_center = self.world.center
-        else:
-            # happens when the window gets drawn before the world got updated
-            self.screen_scale = 1
-            self.world_center = Vec(0, 0)
+        super(WorldViewer, self).recalculate()
 
     def draw(self, widget, cairo_context):
-        c = Canvas(cairo_context)
-        if self.draw_subscriber:
-            self.recalculate()
-            self.draw_subscriber.on_draw_background(c, self)
-            self.draw_subscriber.on_draw_cells(c, self)
-            self.draw_subscriber.on_draw_hud(c, self)
+        """Called by GTK."""
+        self.render(cairo_context)
@@ -0,0 +1,497 @@
+"""
+Connections running in worker processes, so network parsing
+does not compete with drawing for the GIL.
+
+The worker runs an agarnet Client and publishes a compact snapshot
+of its world after each batch of world updates to a SnapshotRing
+in shared memory. The names and eaten cells of each snapshot,
+the leaderboard and other rare events go over a queue,
+as do the packets the drawing process wants to send.
+
+In the drawing process, a ConnectionWorker mirrors the newest snapshot
+into a passive Client, once the queue delivered that snapshot's names and
+eaten cells, and sends the same subscriber events a connected Client would.
+"""
+from collections import deque
+import multiprocessing
+from multiprocessing.shared_memory import SharedMemory
+import queue
+import select
+import struct
+from time import monotonic
+
+import websocket
+
+from agarnet.client import Client
+from agarnet.vec import Vec
+from .connection import PreparedSocket, backoff_delay, open_connection, \
+    socket_readable
+from .subscriber import Coalescer, Subscriber
+
+# cell flags in snapshots
+VIRUS = 1
+AGITATED = 2
+OWN = 4
+
+
+class SnapshotRing(object):
+    """
+    Snapshots of one world in shared memory,
+    written by one process and read by another.
+
+    Each slot is guarded by a sequence lock: the writer makes its sequence
+    number odd while writing, and even again when done. A reader copies
+    the slot and only uses the copy if the sequence number was even
+    and did not change meanwhile.
+    """
+
+    HEADER = struct.Struct('<Q')  # number of the latest snapshot
+    SLOT_HEADER = struct.Struct('<QQI')  # sequence, snapshot number, cell count
+    CELL = struct.Struct('<IfffBBBB')  # cid, x, y, size, r, g, b, flags
+
+    def __init__(self, max_cells=8192, num_slots=4, name=None):
+        """
+        :param name: attach to this existing ring, None to create one
+        """
+        self.max_cells = max_cells
+        self.num_slots = num_slots
+        self.slot_size = self.SLOT_HEADER.size + max_cells * self.CELL.size
+        size = self.HEADER.size + num_slots * self.slot_size
+        self.owner = name is None
+        if self.owner:
+            self.shm = SharedMemory(create=True, size=size)
+        else:
+            # the worker shares the resource tracker of the creating process,
+            # which unlinks the memory if that process did not
+            self.shm = SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.latest = 0  # number of the latest snapshot written or read
+        self.sequences = [0] * num_slots  # written by this process
+
+    def _slot_offset(self, num):
+        return self.HEADER.size + (num % self.num_slots) * self.slot_size
+
+    def write(self, records):
+        """
+        Publishes a snapshot, a list of (cid, x, y, size, r, g, b, flags).
+        Only the first `max_cells` records fit.
+        :return number of records left out
+        """
+        dropped = max(0, len(records) - self.max_cells)
+        records = records[:self.max_cells]
+        num = self.latest + 1
+        slot = num % self.num_slots
+        offset = self._slot_offset(num)
+        data = b''.join(self.CELL.pack(*record) for record in records)
+
+        sequence = self.sequences[slot] + 1  # odd: being written
+        self.SLOT_HEADER.pack_into(self.buf, offset, sequence, num, len(records))
+        start = offset + self.SLOT_HEADER.size
+        self.buf[start:start + len(data)] = data
+        sequence += 1  # even: done
+        self.SLOT_HEADER.pack_into(self.buf, offset, sequence, num, len(records))
+        self.sequences[slot] = sequence
+
+        self.HEADER.pack_into(self.buf, 0, num)
+        self.latest = num
+        return dropped
+
+    def read(self, tries=3):
+        """
+        The newest snapshot, if it is newer than the last one read.
+        :return list of (cid, x, y, size, r, g, b, flags), or None
+        """
+        for _ in range(tries):
+            num, = self.HEADER.unpack_from(self.buf, 0)
+            if num <= self.latest:
+                return None
+            offset = self._slot_offset(num)
+            sequence, slot_num, count = self.SLOT_HEADER.unpack_from(self.buf, offset)
+            if sequence % 2 or slot_num != num:
+                continue  # being written, or already overwritten
+            start = offset + self.SLOT_HEADER.size
+            data = bytes(self.buf[start:start + count * self.CELL.size])
+            if self.SLOT_HEADER.unpack_from(self.buf, offset)[0] == sequence:
+                self.latest = num
+                return list(self.CELL.iter_unpack(data))
+        return None
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+class SnapshotPublisher(Subscriber):
+    """
+    Subscribed to the Client in the worker process.
+    Publishes its world after each world update,
+    and forwards the names, eaten cells and rare events over a queue.
+    """
+
+    FORWARDED = ('on_sock_closed', 'on_world_rect', 'on_leaderboard_names',
+                 'on_respawn', 'on_connect_error', 'on_message_error',
+                 'on_server_version', 'on_experience_info')
+
+    def __init__(self, ring, events):
+        self.ring = ring
+        self.events = events
+        self.client = None
+        self.cells = {}  # cid -> [x, y, size, r, g, b, flags]
+        self.names = {}  # cid -> name, as sent to the drawing process
+        self.new_names = {}  # cid -> name, not sent yet
+        self.eaten = []  # (eater_id, eaten_id), not sent yet
+        self.dropped = 0  # cells that did not fit into the last snapshot
+
+    def __getattr__(self, func_name):
+        if func_name in self.FORWARDED:
+            return lambda *args, **kwargs: \
+                self.events.put((func_name, args, kwargs))
+        return super(SnapshotPublisher, self).__getattr__(func_name)
+
+    def on_sock_open(self):
+        self.on_clear_cells()
+        # snapshots up to this number are from before the connection
+        self.events.put(('on_sock_open', (self.client.address,
+                                          self.client.server_token,
+                                          self.ring.latest), {}))
+
+    def on_clear_cells(self):
+        self.cells.clear()
+        self.names.clear()
+        self.new_names.clear()
+        self.eaten.clear()
+
+    def on_cell_info(self, cid, x, y, size, name, color, is_virus, is_agitated):
+        flags = (VIRUS if is_virus else 0) | (AGITATED if is_agitated else 0)
+        self.cells[cid] = [x, y, size, color[0], color[1], color[2], flags]
+        if name and self.names.get(cid) != name:
+            self.names[cid] = self.new_names[cid] = name
+
+    def on_cell_removed(self, cid):
+        self.cells.pop(cid, None)
+        self.names.pop(cid, None)
+
+    def on_cell_eaten(self, eater_id, eaten_id):
+        self.eaten.append((eater_id, eaten_id))
+        self.on_cell_removed(eaten_id)
+
+    def on_world_update_post(self):
+        # sent before the snapshot, which does not get applied without it
+        self.events.put(('snapshot', (self.ring.latest + 1, self.new_names,
+                                      self.eaten), {}))
+        self.new_names = {}
+        self.eaten = []
+
+        own_ids = self.client.player.own_ids
+        own, others = [], []
+        for cid, (x, y, size, r, g, b, flags) in self.cells.items():
+            if cid in own_ids:
+                own.append((cid, x, y, size, r, g, b, flags | OWN))
+            else:
+                others.append((cid, x, y, size, r, g, b, flags))
+        if len(own) + len(others) > self.ring.max_cells:
+            # own cells always fit, then the largest others
+            others.sort(key=lambda record: record[3], reverse=True)
+        dropped = self.ring.write(own + others)
+        if dropped and not self.dropped:
+            self.on_message_error('Too many cells for the snapshot,'
+                                  ' not showing %i of them' % dropped)
+        self.dropped = dropped
+
+
+def handle_commands(client, commands, timeout=0):
+    """
+    Sends the packets queued by the drawing process,
+    waiting up to `timeout` seconds for commands.
+    :return False when the worker should quit
+    """
+    deadline = monotonic() + timeout
+    while True:
+        try:
+            command = commands.get(timeout=max(0, deadline - monotonic())) \
+                if timeout else commands.get_nowait()
+        except queue.Empty:
+            return True
+        if command[0] == 'quit':
+            return False
+        elif command[0] == 'send' and client.connected:
+            client.ws.send(command[1], opcode=command[2])
+
+
+def run_worker(ring_name, max_cells, num_slots, commands, events,
+               address=None, token=None, max_batch=64):
+    """
+    Entry point of the worker process. Connects, reconnects with backoff,
+    and publishes the world until told to quit.
+    """
+    ring = SnapshotRing(max_cells, num_slots, name=ring_name)
+    publisher = SnapshotPublisher(ring, events)
+    client = publisher.client = Client(publisher)
+    attempt = 0  # failed attempts since the last successful one
+    try:
+        while True:
+            if not client.connected:
+                try:
+                    found_address, found_token, ws = \
+                        open_connection(address, token)
+                    client.ws = PreparedSocket(ws)
+                    connected = client.connect(found_address, found_token)
+                except Exception as e:
+                    publisher.on_connect_error('Connecting failed: %s' % e)
+                    connected = False
+                if not connected:
+                    delay = backoff_delay(attempt)
+                    attempt += 1
+                    if not handle_commands(client, commands, timeout=delay):
+                        return
+                    continue
+                attempt = 0
+
+            if socket_readable(client.ws) \
+                    or select.select([client.ws.sock], [], [], .005)[0]:
+                # process all frames that already arrived, publish once
+                batch = client.subscriber = Coalescer(publisher)
+                try:
+                    for _ in range(max_batch):
+                        client.on_message()
+                        if not client.connected \
+                                or not socket_readable(client.ws):
+                            break
+                except Exception as e:
+                    # nobody would see the traceback, reconnect instead
+                    publisher.on_message_error('Receiving failed: %s' % e)
+                    client.disconnect()
+                finally:
+                    client.subscriber = publisher
+                    batch.flush()
+
+            if not handle_commands(client, commands):
+                return
+    finally:
+        if client.connected:
+            client.disconnect()
+        ring.close()
+
+
+class CommandSocket(object):
+    """
+    Stands in for the websocket of the Client in the drawing process,
+    forwarding everything sent to the worker.
+    """
+
+    def __init__(self, commands):
+        self.commands = commands
+        self.connected = False  # as reported by the worker
+
+    def send(self, payload, opcode=websocket.ABNF.OPCODE_BINARY):
+        self.commands.put(('send', payload, opcode))
+
+    def connect(self, *args, **kwargs):
+        pass  # the worker connects
+
+    def close(self, *args, **kwargs):
+        self.connected = False
+
+    def settimeout(self, timeout):
+        pass
+
+
+class ConnectionWorker(object):
+    """
+    Runs the connection of `client` in a worker process.
+    The client in this process only mirrors the worker's snapshots,
+    call poll() regularly to update it.
+    """
+
+    def __init__(self, client, max_cells=8192, num_slots=4, grace_period=2.):
+        """
+        :param grace_period: seconds a stopped worker gets to quit
+                             before it is terminated
+        """
+        self.client = client
+        self.max_cells = max_cells
+        self.num_slots = num_slots
+        self.grace_period = grace_period
+        self.ring = None
+        self.process = None
+        self.stopping = []  # (process, deadline) of stopped workers
+        self.names = {}  # cid -> name, from the worker
+        self.records = {}  # cid -> (x, y, size, r, g, b, flags) of the last snapshot
+        self.infos = deque()  # (snapshot number, names, eaten) from the worker
+        self.pending = None  # (number, records) of a snapshot without its info
+        self.first_num = 0  # older snapshots are from a previous connection
+
+    def start(self, address=None, token=None):
+        """
+        :param address: None to find any server, also on each reconnect
+        """
+        # fork would copy the GTK state of the drawing process
+        context = multiprocessing.get_context('spawn')
+        self.ring = SnapshotRing(self.max_cells, self.num_slots)
+        self.commands = context.Queue()
+        self.events = context.Queue()
+        self.process = context.Process(
+            target=run_worker, daemon=True,
+            args=(self.ring.name, self.max_cells, self.num_slots,
+                  self.commands, self.events, address, token))
+        self.process.start()
+        self.client.ws = CommandSocket(self.commands)
+
+    def stop(self):
+        """
+        Tells the worker to quit, without waiting for it,
+        call reap() regularly until it returns False.
+        """
+        if not self.process:
+            return
+        self.commands.put(('quit',))
+        self.stopping.append((self.process, monotonic() + self.grace_period))
+        self.process = None
+        self.client.ws.connected = False
+        self.ring.close()
+        self.ring = None
+
+    def reap(self):
+        """
+        Joins stopped workers that quit, terminates the ones
+        that took longer than `grace_period`.
+        :return whether any are left
+        """
+        now = monotonic()
+        stopping = []
+        for process, deadline in self.stopping:
+            if process.is_alive() and now > deadline:
+                process.terminate()
+            if process.is_alive():
+                stopping.append((process, deadline))
+            else:
+                process.join(0)
+        self.stopping = stopping
+        return bool(stopping)
+
+    def poll(self):
+        """
+        Applies the events and the newest snapshot from the worker.
+        :return False if there is no worker or it died, True otherwise
+        """
+        if not self.process:
+            return False
+        while True:
+            try:
+                func_name, args, kwargs = self.events.get_nowait()
+            except queue.Empty:
+                break
+            self.on_event(func_name, args, kwargs)
+        if not self.process.is_alive():
+            exitcode = self.process.exitcode
+            was_connected = self.client.ws.connected
+            self.stop()
+            if was_connected:
+                self.client.subscriber.on_sock_closed()
+            self.client.subscriber.on_connect_error(
+                'Worker process died with exit code %s' % exitcode)
+            return False
+        records = self.ring.read()
+        if records is not None and self.ring.latest >= self.first_num:
+            self.pending = self.ring.latest, records
+        if self.pending and self.infos and self.infos[-1][0] >= self.pending[0]:
+            num, records = self.pending
+            self.pending = None
+            names, eaten = {}, []
+            # also the infos of snapshots that were skipped
+            while self.infos and self.infos[0][0] <= num:
+                _, info_names, info_eaten = self.infos.popleft()
+                names.update(info_names)
+                eaten.extend(info_eaten)
+            self.apply_snapshot(records, names, eaten)
+        return True  # when called by a main loop, keep calling
+
+    def on_event(self, func_name, args, kwargs):
+        client = self.client
+        world = client.player.world
+        if func_name == 'snapshot':
+            self.infos.append(args)
+            return
+        if func_name == 'on_sock_open':
+            client.address, client.server_token, last_num = args
+            client.ws.connected = True
+            self.clear_world()
+            self.first_num = last_num + 1
+            args = ()
+        elif func_name == 'on_sock_closed':
+            client.ws.connected = False
+        elif func_name == 'on_world_rect':
+            world.top_left = Vec(kwargs['left'], kwargs['top'])
+            world.bottom_right = Vec(kwargs['right'], kwargs['bottom'])
+        elif func_name == 'on_leaderboard_names':
+            world.leaderboard_names = args[0] if args else kwargs['leaderboard']
+        getattr(client.subscriber, func_name)(*args, **kwargs)
+
+    def clear_world(self):
+        self.names.clear()
+        self.records.clear()
+        self.infos.clear()
+        self.pending = None
+        self.client.player.world.cells.clear()
+        self.client.player.own_ids.clear()
+
+    def apply_snapshot(self, records, names=None, eaten=()):
+        """
+        Sends cell events for all cells that changed since the last snapshot.
+        :param names: cid -> name, new since the last snapshot
+        :param eaten: (eater_id, eaten_id) since the last snapshot
+        """
+        player = self.client.player
+        world = player.world
+        cells = world.cells
+        subscriber = self.client.subscriber
+        prev_records, self.records = self.records, {}
+        own_ids = set()
+
+        if names:
+            self.names.update(names)
+            for cid, name in names.items():
+                if cid in cells:
+                    cells[cid].name = name
+
+        subscriber.on_world_update_pre()
+        for eater_id, eaten_id in eaten:  # like Client.parse_cell_eating()
+            subscriber.on_cell_eaten(eater_id=eater_id, eaten_id=eaten_id)
+            if eaten_id in player.own_ids:
+                if len(player.own_ids) <= 1:
+                    subscriber.on_death()
+                player.own_ids.remove(eaten_id)
+            if eaten_id in cells:
+                subscriber.on_cell_removed(cid=eaten_id)
+                del cells[eaten_id]
+            prev_records.pop(eaten_id, None)
+            self.names.pop(eaten_id, None)
+
+        for cid, x, y, size, r, g, b, flags in records:
+            record = self.records[cid] = (x, y, size, r, g, b, flags)
+            if flags & OWN:
+                own_ids.add(cid)
+            if prev_records.pop(cid, None) != record:
+                info = dict(cid=cid, x=x, y=y, size=size,
+                            name=self.names.get(cid, ''), color=(r, g, b),
+                            is_virus=bool(flags & VIRUS),
+                            is_agitated=bool(flags & AGITATED))
+                subscriber.on_cell_info(**info)
+                if cid not in cells:
+                    world.create_cell(cid)
+                cells[cid].update(**info)
+        for cid in prev_records:  # not in this snapshot anymore
+            subscriber.on_cell_removed(cid=cid)
+            cells.pop(cid, None)
+            self.names.pop(cid, None)
+
+        player.own_ids.intersection_update(own_ids)
+        for cid in sorted(own_ids - player.own_ids):
+            player.own_ids.add(cid)
+            subscriber.on_own_id(cid=cid)
+        if player.is_alive:
+            player.cells_changed()
+        subscriber.on_world_update_post()
@@ -14,9 +14,12 @@ setup(name='gagar',
       license='GPLv3',
       install_requires=[
           'agarnet >= 0.2.4',
+          'numpy',
           # TODO add gi, gobject, cairo requirements
       ],
-      entry_points={'gui_scripts': ['gagar = gagar.main:main']},
+      entry_points={'gui_scripts': ['gagar = gagar.main:main'],
+                    'console_scripts': ['gagar-bench = gagar.bench:main',
+                                        'gagar-server = gagar.localserver:main']},
       classifiers=[
           'Development Status :: 4 - Beta',
           'Environment :: X11 Applications :: GTK',
@@ -0,0 +1,132 @@
+import http.server
+import os
+import shutil
+import tempfile
+from threading import Thread
+import time
+import unittest
+
+from gagar.skins import SkinLoader
+
+
+class SkinHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep the loader's connection open
+    skins = {}  # name -> PNG data
+    requests = []  # paths, in the order they were requested
+
+    def do_GET(self):
+        self.requests.append(self.path)
+        name = self.path.rsplit('/', 1)[-1][:-len('.png')]
+        if name == 'broken':
+            status, body = 500, b'oops'
+        elif name in self.skins:
+            status, body = 200, self.skins[name]
+        else:
+            status, body = 404, b'not found'
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.time() + timeout
+    while not predicate():
+        if time.time() > deadline:
+            raise AssertionError('timed out')
+        time.sleep(.01)
+
+
+class SkinLoaderTest(unittest.TestCase):
+    def setUp(self):
+        SkinHandler.skins = {'a': b'A' * 100, 'b': b'B' * 100, 'c': b'C' * 100}
+        SkinHandler.requests = []
+        self.server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), SkinHandler)
+        self.server.daemon_threads = True
+        Thread(target=self.server.serve_forever, daemon=True).start()
+        self.base_url = 'http://127.0.0.1:%i/skins/' % self.server.server_port
+        self.tmp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp_dir, 'skins')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmp_dir)
+
+    def loader(self, **kwargs):
+        kwargs.setdefault('cache_dir', self.cache_dir)
+        return SkinLoader(self.base_url, workers=1, **kwargs)
+
+    def load(self, loader, name):
+        wait_for(lambda: loader.get(name) is not None)
+        return loader.get(name)
+
+    def test_download(self):
+        loader = self.loader()
+        self.assertIsNone(loader.get('A'))  # loading in the background
+        self.assertEqual(self.load(loader, 'a'), b'A' * 100)
+        self.assertEqual(SkinHandler.requests, ['/skins/a.png'])
+        with open(os.path.join(self.cache_dir, 'a.png'), 'rb') as f:
+            self.assertEqual(f.read(), b'A' * 100)
+
+    def test_not_found_gives_up(self):
+        loader = self.loader()
+        loader.get('missing')
+        wait_for(lambda: 'missing' in loader._failed)
+        self.assertEqual(loader._failed['missing'], (None, None))
+        self.assertIsNone(loader.get('missing'))
+        time.sleep(.1)
+        self.assertEqual(SkinHandler.requests, ['/skins/missing.png'])
+
+    def test_server_error_retries_with_backoff(self):
+        loader = self.loader(retries=2, retry_delay=.2)
+        loader.get('broken')
+        wait_for(lambda: len(SkinHandler.requests) == 1
+                 and 'broken' in loader._failed)
+        self.assertIsNone(loader.get('broken'))  # too early to retry
+        time.sleep(.05)
+        self.assertEqual(len(SkinHandler.requests), 1)
+
+        time.sleep(.25)
+        loader.get('broken')
+        wait_for(lambda: len(SkinHandler.requests) == 2)
+        wait_for(lambda: loader._failed.get('broken', (0,))[0] == 2)
+        time.sleep(.45)  # the delay doubled
+        loader.get('broken')
+        wait_for(lambda: loader._failed.get('broken') == (None, None))
+        self.assertEqual(len(SkinHandler.requests), 3)
+        time.sleep(.1)
+        self.assertIsNone(loader.get('broken'))
+        self.assertEqual(len(SkinHandler.requests), 3)
+
+    def test_disk_cache_survives_restart(self):
+        self.load(self.loader(), 'a')
+        loader = self.loader()
+        self.assertEqual(self.load(loader, 'a'), b'A' * 100)
+        self.assertEqual(SkinHandler.requests, ['/skins/a.png'])
+
+    def test_unwritable_cache_dir(self):
+        cache_dir = os.path.join(self.tmp_dir, 'file')
+        with open(cache_dir, 'wb'):
+            pass  # a file where the directory should be created
+        loader = self.loader(cache_dir=os.path.join(cache_dir, 'skins'))
+        self.assertEqual(self.load(loader, 'a'), b'A' * 100)
+
+    def test_memory_cap_evicts_least_recently_used(self):
+        loader = self.loader(max_bytes=250)
+        for name in 'abc':
+            self.load(loader, name)
+        self.assertNotIn('a', loader._data)
+        self.assertLessEqual(loader._num_bytes, 250)
+        # evicted skins are read from disk again
+        self.assertEqual(self.load(loader, 'a'), b'A' * 100)
+        self.assertNotIn('b', loader._data)
+        self.assertEqual(len(SkinHandler.requests), 3)
+
+
+if __name__ == '__main__':
+    unittest.main()